@@ -0,0 +1,82 @@
+"""Bytes per GDBVariable and GDBRegister, as measured by tracemalloc.
+
+The variables are built from a -var-list-children reply, and what the
+parsed reply keeps alive is counted too. The "before" rows use copies
+of the classes as they were before they got __slots__, which kept the
+whole MI tuple in a dict. Needs Python 3.4 or later for tracemalloc.
+Run it with "python benchmarks/bench_memory.py".
+"""
+import gc
+import tracemalloc
+
+import sublime_stub
+sublime_stub.install()
+
+from SublimeGDB.sublimegdb import GDBVariable, GDBRegister, parse_result_line
+
+COUNT = 20000
+
+
+class DictVariable:
+    # GDBVariable's fields before __slots__
+    def __init__(self, vp=None, parent=None):
+        self.parent = parent
+        self.valuepair = vp
+        self.children = []
+        self.line = 0
+        self.is_expanded = False
+        self.dirty = False
+        self.deleted = False
+
+
+class DictRegister:
+    # GDBRegister before __slots__
+    def __init__(self, name, index, val):
+        self.name = name
+        self.index = index
+        self.value = val
+        self.line = 0
+        self.lines = 0
+
+
+def children_reply(count):
+    return '^done,numchild="%d",children=[%s],has_more="0"' % (count, ",".join(
+        'child={name="var1.%d",exp="%d",numchild="2",value="{x = %d, y = 2}",type="std::pair<int, int>",thread-id="1"}' % (i, i, i)
+        for i in range(count)))
+
+
+def variable_bytes(cls, reply):
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    children = parse_result_line(reply)["children"].getlist("child")
+    nodes = [cls(child) for child in children]
+    del children
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return used / float(len(nodes))
+
+
+def register_bytes(cls):
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    names = ["r%d" % (i % 32) for i in range(COUNT)]
+    registers = [cls(names[i], i % 32, "0x%016x" % i) for i in range(COUNT)]
+    del names
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return used / float(len(registers))
+
+
+def main():
+    reply = children_reply(COUNT)
+    print("%d nodes, bytes per node" % COUNT)
+    print("GDBVariable  before %6.0f  after %6.0f" % (variable_bytes(DictVariable, reply), variable_bytes(GDBVariable, reply)))
+    print("GDBRegister  before %6.0f  after %6.0f" % (register_bytes(DictRegister), register_bytes(GDBRegister)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Throughput of resultparser.parse_result_line on growing records.
+
+Each size doubles the record, so with a linear parser the time doubles
+too and MB/s stays flat, up to records of several megabytes. Run it
+with "python benchmarks/bench_resultparser.py".
+"""
+import time
+
+import sublime_stub
+sublime_stub.install()
+
+from resultparser import parse_result_line
+
+
+def nested(depth):
+    # like a deeply nested struct from -var-list-children or -stack-list-arguments 1
+    text = '"v"'
+    for i in range(depth):
+        text = '{a="%d",b=[%s]}' % (i, text)
+    return "^done,value=" + text
+
+
+def flat(count):
+    # like -stack-list-frames or -data-disassemble
+    return "^done,stack=[" + ",".join(
+        'frame={level="%d",addr="0x%08x",func="function_%d",file="file.c",fullname="/src/file.c",line="%d"}' % (i, i, i, i)
+        for i in range(count)) + "]"
+
+
+def measure(line, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        parse_result_line(line)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    for name, make, sizes in (("nested", nested, [2000 * 2 ** i for i in range(6)]),
+                              ("flat", flat, [4000 * 2 ** i for i in range(5)])):
+        previous = None
+        print("%-6s %10s %10s %10s %8s" % (name, "size", "seconds", "MB/s", "x prev"))
+        for size in sizes:
+            line = make(size)
+            elapsed = measure(line)
+            ratio = "" if previous is None else "%.2f" % (elapsed / previous)
+            print("%-6s %9.2fM %10.4f %10.1f %8s" % ("", len(line) / 1e6, elapsed, len(line) / elapsed / 1e6, ratio))
+            previous = elapsed
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""GDBVariable.filter_type over a corpus of STL style type names.
+
+Compares applying the type_filters with re.sub on every call, which is
+what filter_type used to do, against the compiled and cached filters.
+Run it with "python benchmarks/bench_type_filter.py".
+"""
+import random
+import re
+import time
+
+import sublime_stub
+
+STRING = "std::__cxx11::basic_string<char, std::char_traits<char>, std::allocator<char> >"
+FILTERS = [
+    {"pattern": re.escape(STRING), "replace": "std::string"},
+    {"pattern": r", std::allocator<[^<>]*(<[^<>]*>)?[^<>]*>", "replace": ""},
+    {"pattern": r"std::__1::", "replace": "std::"},
+    {"pattern": r", std::less<[^<>]*>", "replace": ""},
+]
+
+sublime_stub.install({"type_filters": FILTERS})
+
+from SublimeGDB.sublimegdb import GDBVariable
+
+
+def corpus(count, seed=0):
+    common = [
+        "std::vector<%s, std::allocator<%s> >" % (STRING, STRING),
+        "std::map<int, %s, std::less<int>, std::allocator<std::pair<int const, %s> > >" % (STRING, STRING),
+        "std::vector<int, std::allocator<int> >",
+        "std::__1::unique_ptr<Widget, std::__1::default_delete<Widget> >",
+        "std::__1::shared_ptr<Node>",
+        STRING,
+        "int",
+        "double *",
+        "Widget &",
+    ]
+    rng = random.Random(seed)
+    # mostly the same few types, with a tail of rarely seen ones
+    return [rng.choice(common) if rng.random() < 0.9 else "Grid<%d, %d>" % (rng.randint(0, 100), rng.randint(0, 100))
+            for i in range(count)]
+
+
+def uncached(type):
+    for f in FILTERS:
+        type = re.sub(f["pattern"], f["replace"], type)
+    return type
+
+
+def main():
+    types = corpus(100000)
+    start = time.time()
+    expected = [uncached(type) for type in types]
+    before = time.time() - start
+    start = time.time()
+    filtered = [GDBVariable.filter_type(type) for type in types]
+    after = time.time() - start
+    assert filtered == expected
+    print("%d type names, %d filters" % (len(types), len(FILTERS)))
+    print("re.sub per call:   %.3fs" % before)
+    print("compiled + cached: %.3fs" % after)
+
+
+if __name__ == "__main__":
+    main()
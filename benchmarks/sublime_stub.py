@@ -0,0 +1,49 @@
+"""Just enough of the sublime and sublime_plugin modules to import the
+plugin outside of Sublime Text, which is all the benchmarks need."""
+import os
+import sys
+import types
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Settings(dict):
+    def has(self, key):
+        return key in self
+
+    def set(self, key, value):
+        self[key] = value
+
+    def add_on_change(self, key, on_change):
+        pass
+
+    def clear_on_change(self, key):
+        pass
+
+
+def install(settings=None):
+    settings = Settings(settings or {})
+
+    sublime = types.ModuleType("sublime")
+    sublime.HIDDEN = 1
+    sublime.DRAW_OUTLINED = 2
+    sublime.ENCODED_POSITION = 1
+    sublime.platform = lambda: "linux"
+    sublime.set_timeout = lambda f, ms: None
+    sublime.status_message = lambda msg: None
+    sublime.error_message = lambda msg: None
+    sublime.load_settings = lambda name: settings
+    # no window, so get_setting falls back to the plugin settings
+    sublime.active_window = lambda: None
+    sys.modules["sublime"] = sublime
+
+    sublime_plugin = types.ModuleType("sublime_plugin")
+    for name in ("TextCommand", "WindowCommand", "EventListener"):
+        setattr(sublime_plugin, name, type(name, (object,), {}))
+    sys.modules["sublime_plugin"] = sublime_plugin
+
+    # the plugin imports resultparser as SublimeGDB.resultparser on Python 3
+    package = types.ModuleType("SublimeGDB")
+    package.__path__ = [root]
+    sys.modules["SublimeGDB"] = package
+    sys.path.insert(0, root)
@@ -14,71 +14,290 @@ def cygwin_path_handle(path):
         return path  # do nothing if it is not under windows.
 
 
+class Tuple(dict):
+    """A {} value, or a [] value whose items have keys.
+
+    Repeated keys are collected into a List, use getlist to always get a
+    list back regardless of how many values there were.
+    """
+    __slots__ = ()
+
+    def getlist(self, key):
+        if key not in self:
+            return List()
+        value = self[key]
+        if isinstance(value, List):
+            return value
+        if isinstance(value, Tuple) and len(value) == 0:
+            # [] is parsed as an empty Tuple as there are no items to tell
+            # whether it was a list
+            return List()
+        return List((value,))
+
+
+class List(list):
+    """A [] value whose items don't have keys."""
+    __slots__ = ()
+
+
+class Record(object):
+    __slots__ = ("token", "klass", "results")
+
+    def __init__(self, token, klass, results):
+        self.token = token
+        self.klass = klass
+        self.results = results
+
+
+class ResultRecord(Record):
+    """token^done,..."""
+    __slots__ = ()
+
+
+class ExecAsync(Record):
+    """token*stopped,..."""
+    __slots__ = ()
+
+
+class StatusAsync(Record):
+    """token+download,..."""
+    __slots__ = ()
+
+
+class NotifyAsync(Record):
+    """token=breakpoint-modified,..."""
+    __slots__ = ()
+
+
+class Stream(object):
+    """~"console output", @"target output" or &"log output"."""
+    __slots__ = ("kind", "text")
+
+    def __init__(self, kind, text):
+        self.kind = kind
+        self.text = text
+
+
+record_types = {
+    "^": ResultRecord,
+    "*": ExecAsync,
+    "+": StatusAsync,
+    "=": NotifyAsync
+}
+
+
 def add(d, key, value):
     if key == "file" or key == "fullname" or key == "original-location" or key == "from":
         value = cygwin_path_handle(value)
     if len(key) == 0:
         if len(d) == 0:
-            d = []
+            d = List()
         d.append(value)
         #print "%s" % r
     else:
         if key not in d:
             d[key] = value
         else:
-            if not isinstance(d[key], list):
+            if not isinstance(d[key], List):
                 tmp = d[key]
-                d[key] = []
+                d[key] = List()
                 d[key].append(tmp)
             d[key].append(value)
     return d
 
 
-def _parse_result_line(line):
-    start = 0
-    inComment = False
+# Characters that are significant outside of a quoted string. Everything
+# else is skipped over in one go by searching for the next one of these.
+token_regex = re.compile(r"[=\",{}\[\] \r\n]")
+# Everything up to the next bracket that is not inside a quoted string
+skip_regex = re.compile(r"(?:[^\"{}\[\]]+|\"[^\"\\]*(?:\\\"?[^\"\\]*)*\")*")
+
+
+def _find_string_end(line, start):
+    # A quote preceded by a backslash is escaped
+    end = line.find("\"", start)
+    while end > start and line[end - 1] == "\\":
+        end = line.find("\"", end + 1)
+    return end
+
+
+def _skip_value(line, i):
+    # Returns the index just past the tuple or list opened at line[i], or -1
+    # if the line ends before it is closed
+    depth = 0
+    match = skip_regex.match
+    n = len(line)
+    while i < n:
+        c = line[i]
+        if c == "{" or c == "[":
+            depth += 1
+        elif c == "}" or c == "]":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        else:
+            # an unterminated string
+            return -1
+        i = match(line, i + 1).end()
+    return -1
+
+
+def _path_tree(paths):
+    # Turns ["frame.func", "frame.line"] into {"frame": {"func": None, "line": None}},
+    # where None means that the whole value is wanted
+    tree = {}
+    for path in paths:
+        node = tree
+        keys = path.split(".")
+        for key in keys[:-1]:
+            child = node.get(key, {})
+            if child is None:
+                break
+            node = node.setdefault(key, child)
+        else:
+            node[keys[-1]] = None
+    return tree
+
+
+def _parse_result_line(line, want=None):
+    # Works on indexes into the one line rather than recursing on slices of
+    # it, so that deeply nested records are parsed in linear time. Each
+    # entry in stack is the (dict, key, start, want) of an enclosing tuple or
+    # list.
+    #
+    # want is a tree from _path_tree, or None to keep everything. Values not
+    # in it are skipped without being decoded or built. List items have no
+    # key and are kept whenever their list is.
+    #
+    # Returns the index parsing stopped at along with the results, the index
+    # is -1 if the line was truncated inside a string, tuple or list.
+    stack = []
     key = ""
-    value = ""
+    start = 0
     i = 0
-    subparse = 0
-    d = {}
-    while i < len(line):
+    d = Tuple()
+    search = token_regex.search
+    while True:
+        m = search(line, i)
+        if m is None:
+            i = len(line)
+            break
+        i = m.start()
         c = line[i]
-        if inComment:
-            if c == "\"":
-                inComment = False
-                value = decoder(line[start:i])[0]
-                d = add(d, key, value)
-                key = ""
-                start = i + 1
-            elif c == "\\":
-                if line[i + 1] == "\"":
-                    i += 1
-        else:
-            if c == "=":
-                key = line[start:i]
-                start = i + 1
-            elif c == "\"":
-                inComment = True
-                start = i + 1
-            elif c == "," or c == " " or c == "\n" or c == "\r":
-                start = i + 1
-            elif c == "{" or c == "[":
-                subparse += 1
-                start = i + 1
-                (pos, r) = _parse_result_line(line[start:])
-                d = add(d, key, r)
-                i = start + pos
-                continue
-            elif c == "}" or c == "]":
-                if subparse > 0:
-                    subparse -= 1
-                else:
+        if c == "\"":
+            start = i + 1
+            end = _find_string_end(line, start)
+            if end == -1:
+                i = -1
+                break
+            if want is None or key in want:
+                d = add(d, key, decoder(line[start:end])[0])
+            key = ""
+            i = start = end + 1
+            continue
+        elif c == "=":
+            key = line[start:i]
+            start = i + 1
+        elif c == "{" or c == "[":
+            if want is None or key == "":
+                child = want
+            elif key in want:
+                child = want[key]
+            else:
+                i = _skip_value(line, i)
+                if i == -1:
                     break
-
+                start = i
+                continue
+            stack.append((d, key, i + 1, want))
+            d = Tuple()
+            key = ""
+            start = i + 1
+            want = child
+        elif c == "}" or c == "]":
+            if not stack:
+                break
+            parent, key, start, want = stack.pop()
+            d = add(parent, key, d)
+        else:
+            start = i + 1
         i += 1
+
+    # close any tuples and lists left open by a truncated line
+    if stack:
+        i = -1
+    while stack:
+        parent, key, start, want = stack.pop()
+        d = add(parent, key, d)
     return (i, d)
 
 
-def parse_result_line(line):
-    return _parse_result_line(line)[1]
+def parse_result_line(line, paths=None):
+    """Parses the results of an MI record into Tuples and Lists.
+
+    If paths is given only those values are parsed, the rest of the record
+    is skipped. A path is a dot separated list of keys such as
+    "stack.frame.func"; list items do not take up a key in the path.
+    """
+    if paths is None:
+        return _parse_result_line(line)[1]
+    return _parse_result_line(line, _path_tree(paths))[1]
+
+
+record_regex = re.compile(r"(\d*)([\^*+=~@&])")
+class_regex = re.compile(r"[a-z-]+")
+# The first result after the class, key=
+results_regex = re.compile(r",[a-zA-Z_][\w-]*=")
+# A whole quoted string running to the end of the line
+stream_regex = re.compile(r"\"(?:[^\"\\]|\\.)*\"$")
+
+# The classes gdb uses for each kind of record, a line with any other class
+# is the program's own output
+record_classes = {
+    "^": frozenset(["done", "running", "connected", "error", "exit"]),
+    "*": frozenset(["running", "stopped"]),
+    "+": frozenset(["download"]),
+    "=": frozenset([
+        "thread-group-added", "thread-group-removed", "thread-group-started",
+        "thread-group-exited", "thread-created", "thread-exited",
+        "thread-selected", "library-loaded", "library-unloaded",
+        "traceframe-changed", "tsv-created", "tsv-deleted", "tsv-modified",
+        "breakpoint-created", "breakpoint-modified", "breakpoint-deleted",
+        "record-started", "record-stopped", "cmd-param-changed",
+        "memory-changed"
+    ])
+}
+
+
+def unescape_stream(text):
+    return text.replace("\\n", "\n").replace("\\\"", "\"").replace("\\t", "\t")
+
+
+def parse_record(line, paths=None):
+    """Parses an MI output line into a Record or a Stream.
+
+    Only a line that is MI output as a whole is a record: a known class
+    followed by nothing or by results, or a single quoted stream string.
+    Returns None for the "(gdb)" prompt and for anything else, such as the
+    program's own output. paths is passed on to parse_result_line.
+    """
+    m = record_regex.match(line)
+    if m is None:
+        return None
+    token = int(m.group(1)) if m.group(1) else None
+    kind = m.group(2)
+    if kind in "~@&":
+        if token is not None or stream_regex.match(line, m.end()) is None:
+            return None
+        return Stream(kind, unescape_stream(line[m.end() + 1:-1]))
+    c = class_regex.match(line, m.end())
+    if c is None or c.group(0) not in record_classes[kind]:
+        return None
+    klass = c.group(0)
+    end = c.end()
+    if end == len(line):
+        return record_types[kind](token, klass, Tuple())
+    if results_regex.match(line, end) is None or line[-1] not in "\"}]" or \
+            _parse_result_line(line, {})[0] != len(line):
+        return None
+    return record_types[kind](token, klass, parse_result_line(line, paths))
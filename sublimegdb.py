@@ -31,12 +31,15 @@ import traceback
 import os
 import sys
 import re
-import queue
-from datetime import datetime
+import collections
+import gzip
+import mmap
+import shutil
+import select
 from functools import partial
 try:
     import Queue
-    from resultparser import parse_result_line
+    from resultparser import parse_result_line, parse_record, ResultRecord, ExecAsync, Stream, Tuple
 
     def sencode(s):
         return s.encode("utf-8")
@@ -48,6 +51,11 @@ try:
         return s
     def bdecode(s):
         return s
+
+    def sintern(s):
+        if type(s) is str:
+            return intern(s)
+        return s
 except:
     def sencode(s):
         return s
@@ -61,28 +69,67 @@ except:
     def bdecode(s):
         return s.decode("utf-8")
 
+    def sintern(s):
+        return sys.intern(s)
+
     import queue as Queue
-    from SublimeGDB.resultparser import parse_result_line
+    from SublimeGDB.resultparser import parse_result_line, parse_record, ResultRecord, ExecAsync, Stream, Tuple
 
 exec_settings = {}
+# Resolved settings per view id (None when there is no view), cleared
+# whenever the view's settings, the plugin settings or exec_settings change.
+settings_cache = {}
+settings_listening = set()
+setting_unset = object()
+
+
+def set_exec_settings(settings):
+    global exec_settings
+    exec_settings = settings
+    settings_cache.clear()
+
+
+def forget_view_settings(view_id):
+    settings_cache.pop(view_id, None)
 
-def get_setting(key, default=None, view=None):
-    try:
-        if view is None:
-            view = sublime.active_window().active_view()
-        s = view.settings()
 
+def lookup_setting(key, view):
+    try:
         # Try executable specific settings first
         if exec_settings and key in exec_settings:
             return exec_settings[key]
         # Then try user settings
+        s = view.settings()
         if s.has("sublimegdb_%s" % key):
             return s.get("sublimegdb_%s" % key)
     except:
         pass
 
     # Default settings
-    return sublime.load_settings("SublimeGDB.sublime-settings").get(key, default)
+    return sublime.load_settings("SublimeGDB.sublime-settings").get(key, setting_unset)
+
+
+def get_setting(key, default=None, view=None):
+    try:
+        if view is None:
+            view = sublime.active_window().active_view()
+        view_id = view.id()
+    except:
+        view_id = None
+    try:
+        value = settings_cache[view_id][key]
+    except KeyError:
+        if not settings_listening:
+            settings_listening.add(None)
+            sublime.load_settings("SublimeGDB.sublime-settings").add_on_change("sublimegdb", settings_cache.clear)
+        if view_id not in settings_listening:
+            settings_listening.add(view_id)
+            view.settings().add_on_change("sublimegdb", partial(forget_view_settings, view_id))
+        value = lookup_setting(key, view)
+        settings_cache.setdefault(view_id, {})[key] = value
+    if value is setting_unset:
+        return default
+    return value
 
 
 def expand_path(value, window):
@@ -127,10 +174,8 @@ def expand_path(value, window):
 
 DEBUG = None
 DEBUG_FILE = None
-__debug_file_handle = None
 
 gdb_lastline = ""
-gdb_lastresult = queue.Queue()
 gdb_last_console_line = ""
 gdb_cursor = ""
 gdb_cursor_position = 0
@@ -145,6 +190,9 @@ gdb_process = None
 gdb_server_process = None
 gdb_threads = []
 gdb_stack_frame = None
+# Bumped on every run status change, so that a refresh started for an
+# older stop can tell that it is out of date and give up
+gdb_stop_generation = 0
 gdb_stack_index = 0
 
 gdb_nonstop = False
@@ -163,21 +211,241 @@ def normalize(filename):
     return os.path.abspath(os.path.normcase(filename))
 
 
-def log_debug(line):
-    global __debug_file_handle
-    global DEBUG
-    if DEBUG:
-        try:
-            if __debug_file_handle is None:
-                if DEBUG_FILE == "stdout":
-                    __debug_file_handle = sys.stdout
+class GDBDebugLog(object):
+    """Writes the debug log from a background thread.
+
+    log_debug only queues the text; the writer thread writes whatever has
+    queued up in one go and flushes once per batch. When the file grows
+    past debug_file_max_size it is rotated to <file>.1 (and .1.gz with
+    debug_file_compress), keeping debug_file_backups old files. Without a
+    debug_file the last debug_ring_size messages are kept in memory
+    instead, see "SublimeGDB: Show Debug Log".
+    """
+    # queued by close, the file is closed once what came before it has been
+    # written and opened again if more is logged after it
+    close_marker = object()
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.filename = None
+        self.handle = None
+        self.size = 0
+        self.max_size = 0
+        self.backups = 0
+        self.compress = False
+        self.ring = collections.deque(maxlen=10000)
+
+    def open(self, filename):
+        if self.thread is not None:
+            # launch runs off the UI thread, so waiting here is fine
+            self.queue.put(None)
+            self.thread.join(5)
+            self.queue = Queue.Queue()
+            self.thread = None
+        self.filename = filename
+        self.max_size = get_setting("debug_file_max_size", 0)
+        self.backups = get_setting("debug_file_backups", 3)
+        self.compress = get_setting("debug_file_compress", False)
+        self.ring = collections.deque(maxlen=get_setting("debug_ring_size", 10000))
+        if filename:
+            self.thread = threading.Thread(target=self.run, args=(self.queue,))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, line):
+        if self.thread is None:
+            self.ring.append(line)
+        else:
+            self.queue.put(line)
+
+    def close(self):
+        # doesn't wait for the writer, which keeps going until the next open
+        if self.thread is not None:
+            self.queue.put(self.close_marker)
+
+    def run(self, queue):
+        while True:
+            items = [queue.get()]
+            try:
+                while len(items) < 1000:
+                    items.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            lines = []
+            for item in items:
+                if item is None or item is self.close_marker:
+                    self.write_lines(lines)
+                    lines = []
+                    self.close_handle()
+                    if item is None:
+                        return
                 else:
-                    __debug_file_handle = open(DEBUG_FILE, 'a')
-            __debug_file_handle.write(line)
+                    lines.append(item)
+            self.write_lines(lines)
+
+    def write_lines(self, lines):
+        global DEBUG
+        if not lines or not DEBUG:
+            return
+        try:
+            self.write_data("".join(lines))
         except:
-            sublime.error_message("Couldn't write to the debug file. Debug writes will be disabled for this session.\n\nDebug file name used:\n%s\n\nError message\n:%s" % (DEBUG_FILE, traceback.format_exc()))
+            msg = "Couldn't write to the debug file. Debug writes will be disabled for this session.\n\nDebug file name used:\n%s\n\nError message\n:%s" % (self.filename, traceback.format_exc())
+            sublime.set_timeout(partial(sublime.error_message, msg), 0)
             DEBUG = False
 
+    def close_handle(self):
+        if self.handle is not None and self.handle != sys.stdout:
+            self.handle.close()
+        self.handle = None
+
+    def write_data(self, data):
+        if self.handle is None:
+            if self.filename == "stdout":
+                self.handle = sys.stdout
+            else:
+                # written as utf-8 bytes, whatever the locale's encoding is
+                self.handle = open(self.filename, 'ab')
+                self.size = os.path.getsize(self.filename)
+        if self.handle == sys.stdout:
+            self.handle.write(data)
+            self.handle.flush()
+            return
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8", "replace")
+        self.handle.write(data)
+        self.handle.flush()
+        self.size += len(data)
+        if self.max_size > 0 and self.size >= self.max_size:
+            self.rotate()
+
+    def rotate(self):
+        self.handle.close()
+        self.handle = None
+        ext = ".gz" if self.compress else ""
+
+        def backup(i):
+            return "%s.%d%s" % (self.filename, i, ext)
+        if os.path.exists(backup(self.backups)):
+            os.remove(backup(self.backups))
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(backup(i)):
+                os.rename(backup(i), backup(i + 1))
+        if self.backups <= 0:
+            os.remove(self.filename)
+        elif self.compress:
+            with open(self.filename, "rb") as src:
+                with gzip.open(backup(1), "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            os.remove(self.filename)
+        else:
+            os.rename(self.filename, backup(1))
+
+
+gdb_debug_log = GDBDebugLog()
+
+
+def log_debug(line):
+    if DEBUG:
+        gdb_debug_log.write(line)
+
+
+class GDBWorker(object):
+    """Runs the functions posted to it one at a time on a background thread.
+
+    Everything that waits for gdb after a stop goes through here rather than
+    sublime.set_timeout, so the editor doesn't freeze while gdb answers.
+    The views hand their text and regions back to the UI thread themselves.
+    """
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def post(self, func, *args):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, args=(self.queue,))
+                self.thread.daemon = True
+                self.thread.start()
+            self.queue.put(partial(func, *args))
+
+    def stop(self):
+        with self.lock:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.queue = Queue.Queue()
+                self.thread = None
+
+    def run(self, queue):
+        while True:
+            func = queue.get()
+            if func is None:
+                break
+            try:
+                func()
+            except:
+                traceback.print_exc()
+
+
+gdb_worker = GDBWorker()
+
+
+class GDBRenderScheduler(object):
+    """Flushes the output added to the views with add_line on the UI thread.
+
+    Output is buffered per view and all views are flushed together at most
+    render_rate times a second. A flush stops once it has taken
+    render_budget milliseconds and leaves the rest for the next one.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.scheduled = False
+        self.last_flush = 0
+        self.interval = 1.0 / 30
+        self.budget = 0.01
+        # how long the slowest flush so far took, in seconds
+        self.max_flush_time = 0
+
+    def schedule(self, view):
+        with self.lock:
+            if view not in self.pending:
+                self.pending.append(view)
+            if self.scheduled:
+                return
+            self.scheduled = True
+            delay = max(0, self.interval - (time.time() - self.last_flush))
+        sublime.set_timeout(self.flush, int(delay * 1000))
+
+    def flush(self):
+        self.interval = 1.0 / max(1, get_setting("render_rate", 30))
+        self.budget = get_setting("render_budget", 10) / 1000.0
+        with self.lock:
+            views = self.pending
+            self.pending = []
+            self.scheduled = False
+        start = time.time()
+        deadline = start + self.budget
+        remaining = []
+        for i in range(len(views)):
+            views[i].flush_lines()
+            if not views[i].update(deadline):
+                remaining = views[i:]
+                break
+            if time.time() > deadline:
+                remaining = views[i + 1:]
+                break
+        self.last_flush = time.time()
+        self.max_flush_time = max(self.max_flush_time, self.last_flush - start)
+        # out of time, the rest waits for the next flush
+        for view in remaining:
+            self.schedule(view)
+
+
+gdb_render_scheduler = GDBRenderScheduler()
+
 
 class GDBView(object):
     def __init__(self, name, s=True, settingsprefix=None):
@@ -187,9 +455,16 @@ class GDBView(object):
         self.doScroll = s
         self.view = None
         self.settingsprefix = settingsprefix
-        self.timer = None
-        self.lines = ""
+        self.lines = []
         self.lock = threading.RLock()
+        # set when a refresh was skipped because the view was hidden
+        self.stale = False
+        # the lines last given to replace, or None if the view has been
+        # changed some other way since
+        self.rendered = []
+        # file the complete output given to add_line is also written to, see
+        # the <settingsprefix>_log_file setting
+        self.log_file = None
 
     def is_open(self):
         return not self.closed
@@ -214,37 +489,92 @@ class GDBView(object):
     def should_update(self):
         return self.is_open() and is_running() and gdb_run_status == "stopped"
 
+    def is_visible(self):
+        # whether the view is the selected one in its group
+        if not self.is_open():
+            return False
+        window = self.view.window()
+        if window is None:
+            return False
+        group, index = window.get_view_index(self.view)
+        active = window.active_view_in_group(group)
+        return active is not None and active.id() == self.view.id()
+
+    def defer_update(self):
+        # Hidden views don't query gdb, they are marked stale instead and
+        # catch up in on_activated
+        if self.should_update() and not self.is_visible():
+            self.stale = True
+            return True
+        return False
+
+    def refresh(self):
+        # Brings a stale view up to date, run on gdb_worker
+        pass
+
+    def catch_up(self):
+        if self.stale and self.should_update():
+            self.stale = False
+            self.refresh()
+            sublime.set_timeout(update_view_markers, 0)
+
     def set_syntax(self, syntax):
         if self.is_open():
             self.get_view().set_syntax_file(syntax)
 
 
-    def timed_add(self):
-        try:
-            self.lock.acquire()
-            lines = self.lines
-            self.lines = ""
-            self.timer = None
-            self.queue.put((self.do_add_line, lines))
-            sublime.set_timeout(self.update, 0)
-        finally:
-            self.lock.release()
-
-
-    def add_line(self, line, now=True):
+    def add_line(self, line):
+        self.log_line(line)
         if self.is_open():
+            with self.lock:
+                self.rendered = None
+                self.lines.append(line)
+            gdb_render_scheduler.schedule(self)
+
+    def log_line(self, line):
+        if self.settingsprefix is None:
+            return
+        with self.lock:
+            if self.log_file is None:
+                filename = get_setting("%s_log_file" % self.settingsprefix, "")
+                if not filename:
+                    return
+                try:
+                    # written as utf-8 bytes, whatever the locale's encoding is
+                    self.log_file = open(expand_path(filename, None), "ab")
+                except:
+                    traceback.print_exc()
+                    return
             try:
-                self.lock.acquire()
-                self.lines += line
-                if self.timer:
-                    self.timer.cancel()
-                if self.lines.count("\n") > 10 or now:
-                    self.timed_add()
-                else:
-                    self.timer = threading.Timer(0.1, self.timed_add)
-                    self.timer.start()
-            finally:
-                self.lock.release()
+                self.log_file.write(line if isinstance(line, bytes) else line.encode("utf-8", "replace"))
+            except:
+                # losing a line of the log mustn't stop the output, or the
+                # command that is being sent to gdb
+                traceback.print_exc()
+
+    def close_log(self):
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+
+    def flush_lines(self):
+        # Moves the output buffered by add_line to the view's queue, in
+        # pieces of about 64 KiB so that update can stop between them once
+        # it's out of time.
+        with self.lock:
+            lines = self.lines
+            self.lines = []
+        text = "".join(lines)
+        start = 0
+        while start < len(text):
+            end = start + 65536
+            if end < len(text):
+                newline = text.rfind("\n", start, end)
+                if newline != -1:
+                    end = newline + 1
+            self.queue.put((self.do_add_line, text[start:end]))
+            start = end
 
     def scroll(self, line):
         if self.is_open():
@@ -256,8 +586,35 @@ class GDBView(object):
             self.queue.put((self.do_set_viewport_position, pos))
             sublime.set_timeout(self.update, 0)
 
+    def replace(self, text):
+        # Replaces everything in the view with text, keeping the viewport
+        # where it was. Only the lines that differ from the last call are
+        # rewritten, which keeps folding and the selection intact.
+        if self.is_open():
+            lines = text.splitlines(True)
+            with self.lock:
+                if self.rendered is None:
+                    hunks = [(0, None, text)]
+                else:
+                    hunks = diff_lines(self.rendered, lines)
+                self.rendered = lines
+                if hunks:
+                    self.queue.put((self.do_replace, hunks))
+            if hunks:
+                sublime.set_timeout(self.update, 0)
+
+    def add_line_regions(self, key, lines, scope, icon, flags):
+        # lines is a list of (first line, number of lines) pairs. The regions
+        # are only created once the text they refer to is in the view.
+        if self.is_open():
+            self.queue.put((self.do_add_line_regions, (key, lines, scope, icon, flags)))
+            sublime.set_timeout(self.update, 0)
+
     def clear(self, now=False):
         if self.is_open():
+            with self.lock:
+                self.rendered = []
+                self.lines = []
             if not now:
                 self.queue.put((self.do_clear, None))
                 sublime.set_timeout(self.update, 0)
@@ -274,6 +631,7 @@ class GDBView(object):
         # does not eat the "enter" keybinding
         self.view.settings().set('command_mode', False)
         self.closed = False
+        self.rendered = []
 
     def destroy_view(self):
         sublime.active_window().focus_view(self.view)
@@ -296,6 +654,15 @@ class GDBView(object):
 
     def do_add_line(self, line):
         self.view.run_command("gdb_view_add_line", {"line": line, "doScroll": self.doScroll})
+        if self.settingsprefix is None:
+            return
+        max_lines = get_setting("%s_max_lines" % self.settingsprefix, 0)
+        if max_lines > 0:
+            # trim in bulk once there are 10% too many lines rather than a
+            # few lines on every add
+            lines = self.view.rowcol(self.view.size())[0]
+            if lines > max_lines + max(1, max_lines // 10):
+                self.view.run_command("gdb_view_trim", {"lines": lines - max_lines})
 
     def do_fold_all(self, data):
         self.view.run_command("fold_all")
@@ -303,6 +670,22 @@ class GDBView(object):
     def do_clear(self, data):
         self.view.run_command("gdb_view_clear")
 
+    def do_replace(self, data):
+        pos = self.view.viewport_position()
+        self.view.run_command("gdb_view_replace", {"hunks": data})
+        self.do_set_viewport_position(pos)
+
+    def do_add_line_regions(self, data):
+        key, lines, scope, icon, flags = data
+        v = self.view
+        regions = []
+        for line, count in lines:
+            region = v.full_line(v.text_point(line, 0))
+            if count > 1:
+                region = region.cover(v.full_line(v.text_point(line + count - 1, 0)))
+            regions.append(region)
+        v.add_regions(key, regions, scope, icon, flags)
+
     def do_scroll(self, data):
         self.view.run_command("goto_line", {"line": data + 1})
 
@@ -319,11 +702,14 @@ class GDBView(object):
         self.view.viewport_extent()
         self.view.set_viewport_position(data, False)
 
-    def update(self):
+    def update(self, deadline=None):
+        # Returns False if deadline passed before everything queued was done
         if not self.is_open():
-            return
+            return True
         try:
             while not self.queue.empty():
+                if deadline is not None and time.time() > deadline:
+                    return False
                 cmd, data = self.queue.get()
                 try:
                     cmd(data)
@@ -331,6 +717,7 @@ class GDBView(object):
                     self.queue.task_done()
         except:
             traceback.print_exc()
+        return True
 
     def on_activated(self):
         # scroll to the end of the view on first activation
@@ -338,18 +725,79 @@ class GDBView(object):
             # need a timeout because apparently a view can't be scrolled until
             # it has been fully activated once
             sublime.set_timeout(self.do_move_to_eof, 20)
+        if self.stale:
+            gdb_worker.post(self.catch_up)
 
     def on_session_ended(self):
+        self.stale = False
+        self.close_log()
         if get_setting("%s_clear_on_end" % self.settingsprefix, True):
             self.clear()
 
 
+def diff_lines(old, new):
+    """Returns the (first line, number of old lines, new text) hunks that
+    turn the lines in old into the ones in new."""
+    start = 0
+    end = min(len(old), len(new))
+    while start < end and old[start] == new[start]:
+        start += 1
+    old_end = len(old)
+    new_end = len(new)
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+    if start == old_end and start == new_end:
+        return []
+    if old_end - start != new_end - start:
+        return [(start, old_end - start, "".join(new[start:new_end]))]
+
+    # the same number of lines changed, so only the runs of lines that
+    # actually differ need to be rewritten
+    hunks = []
+    i = start
+    while i < old_end:
+        if old[i] == new[i]:
+            i += 1
+            continue
+        first = i
+        while i < old_end and old[i] != new[i]:
+            i += 1
+        hunks.append((first, i - first, "".join(new[first:i])))
+    return hunks
+
+
+class GdbViewTrim(sublime_plugin.TextCommand):
+    def run(self, edit, lines):
+        # removes the given number of lines from the start of the view
+        self.view.set_read_only(False)
+        self.view.erase(edit, sublime.Region(0, self.view.text_point(lines, 0)))
+        self.view.set_read_only(True)
+
+
 class GdbViewClear(sublime_plugin.TextCommand):
     def run(self, edit):
         self.view.set_read_only(False)
         self.view.erase(edit, sublime.Region(0, self.view.size()))
         self.view.set_read_only(True)
 
+class GdbViewReplace(sublime_plugin.TextCommand):
+    def run(self, edit, hunks):
+        # hunks are (first line, number of lines, new text) and are applied
+        # from the bottom up so that the line numbers stay valid. A None
+        # number of lines replaces everything.
+        self.view.set_read_only(False)
+        for line, count, text in reversed(hunks):
+            if count is None:
+                region = sublime.Region(0, self.view.size())
+            else:
+                start = self.view.text_point(line, 0)
+                end = self.view.text_point(line + count, 0) if count > 0 else start
+                region = sublime.Region(start, end)
+            self.view.replace(edit, region, text)
+        self.view.set_read_only(True)
+
+
 class GdbViewAddLine(sublime_plugin.TextCommand):
     def run(self, edit, line, doScroll):
         # force a scroll to the end if the last line is currently visible
@@ -362,17 +810,36 @@ class GdbViewAddLine(sublime_plugin.TextCommand):
         if force_scroll:
             self.view.run_command("move_to", { "to": "eof", "extend": False })
 
-class GDBVariable:
+class GDBVariable(object):
+    # the parts of the varobj's MI tuple that are kept, the item access
+    # methods below make them look like a dict
+    fields = ("name", "exp", "type", "value", "numchild", "dynamic", "has_more", "dynamic_type", "typecode")
+    __slots__ = fields + ("parent", "children", "line", "depth", "is_expanded", "dirty", "deleted",
+                          "child_count", "next_child", "has_more_children")
+
     def __init__(self, vp=None, parent=None):
         self.parent = parent
-        self.valuepair = vp
+        for key in self.fields:
+            setattr(self, key, None)
+        for key in vp:
+            self[key] = vp[key]
+        if self.numchild is None:
+            self.numchild = 0
         self.children = []
         self.line = 0
+        self.depth = 0
         self.is_expanded = False
-        if "value" not in vp:
+        if self.value is None:
             self.update_value()
         self.dirty = False
         self.deleted = False
+        # non-zero if a dynamic varobj without has_more has children, found
+        # by GDBVariablesView.fetch_child_counts
+        self.child_count = None
+        # children are listed a page at a time, next_child is the index of
+        # the first one not listed yet
+        self.next_child = 0
+        self.has_more_children = False
 
     def delete(self):
         run_cmd("-var-delete %s" % self.get_name())
@@ -381,7 +848,7 @@ class GDBVariable:
     def update_value(self):
         line = run_cmd("-var-evaluate-expression %s" % self["name"], True)
         if get_result(line) == "done":
-            self['value'] = parse_result_line(line)["value"]
+            self['value'] = parse_result_line(line, ["value"])["value"]
 
     def update(self, d):
         for key in d:
@@ -400,19 +867,10 @@ class GDBVariable:
         if self.parent:
             return True
 
-        # try to find the line where this variable was declared
-        output = run_python_cmd("python print(gdb.lookup_symbol(\"%s\")[0].line)" % self["exp"], True)
-        try:
-            line = int(output)
-
-            # if the cursor is after this position the variable should be
-            # existing
-            if gdb_cursor_position > line:
-                return True
-        except:
-            pass
-
-        return False
+        # if the cursor is after the line where this variable was declared
+        # it should be existing
+        line = gdb_variables_view.get_declaration_line(self["exp"])
+        return line is not None and gdb_cursor_position > line
 
     def get_expression(self):
         expression = ""
@@ -424,8 +882,19 @@ class GDBVariable:
         expression += self["exp"]
         return expression
 
-    def add_children(self, name):
-        children = listify(parse_result_line(run_cmd("-var-list-children 1 \"%s\"" % name, True))["children"]["child"])
+    def add_children(self, name, count=0):
+        # lists count children from next_child on, or all of them when count is 0
+        cmd = "-var-list-children 1 \"%s\"" % name
+        if count:
+            cmd += " %d %d" % (self.next_child, self.next_child + count)
+        res = parse_result_line(run_cmd(cmd, True))
+        children = res.get("children", Tuple()).getlist("child")
+        if count:
+            self.next_child += len(children)
+            if self.is_dynamic:
+                self.has_more_children = len(children) > 0 and int(res.get("has_more", 0)) > 0
+            else:
+                self.has_more_children = self.next_child < self.numchild
         for child in children:
             child = GDBVariable(child, parent=self)
             if child.get_name().endswith(".private") or \
@@ -436,6 +905,20 @@ class GDBVariable:
             else:
                 self.children.append(child)
 
+    def load_more_children(self):
+        self.add_children(self.get_name(), get_setting("variables_page_size", 100))
+        if self.is_dynamic:
+            # -var-update only has to look at the children that have been listed
+            write_cmd("-var-set-update-range %s 0 %d" % (self.get_name(), self.next_child))
+
+    def delete_children(self):
+        run_cmd("-var-delete -c %s" % self.get_name())
+        for child in self.children:
+            child.deleted = True
+        self.children = []
+        self.next_child = 0
+        self.has_more_children = False
+
     def is_editable(self):
         line = run_cmd("-var-show-attributes %s" % (self.get_name()), True)
         return "editable" in re.findall("(?<=attr=\")[a-z]+(?=\")", line)
@@ -443,50 +926,39 @@ class GDBVariable:
     def edit_on_done(self, val):
         line = run_cmd("-var-assign %s \"%s\"" % (self.get_name(), val), True)
         if get_result(line) == "done":
-            self.valuepair["value"] = parse_result_line(line)["value"]
-            gdb_variables_view.update_variables(True)
+            self.value = parse_result_line(line, ["value"])["value"]
+            gdb_worker.post(gdb_variables_view.update_variables, True)
         else:
             err = line[line.find("msg=") + 4:]
             sublime.status_message("Error: %s" % err)
 
-    def find(self, name):
-        if self.deleted:
-            return None
-        if name == self.get_name():
-            return self
-        elif name.startswith(self.get_name()):
-            for child in self.children:
-                ret = child.find(name)
-                if ret is not None:
-                    return ret
-        return None
-
     def edit(self):
-        sublime.active_window().show_input_panel("%s =" % self["exp"], self.valuepair["value"], self.edit_on_done, None, None)
+        sublime.active_window().show_input_panel("%s =" % self["exp"], self.value, self.edit_on_done, None, None)
 
     def get_name(self):
-        return self.valuepair["name"]
+        return self.name
 
     def expand(self):
         if not self.is_existing():
             return
 
         self.is_expanded = True
-        if ((not self.children) and self.has_children()):
-            self.add_children(self.get_name())
+        if not self.children:
+            gdb_variables_view.fetch_child_counts([self])
+            if self.has_children():
+                self.load_more_children()
 
     def has_children(self):
-        if (int(self["numchild"]) > 0 or
-                (self.is_dynamic and int(self.valuepair.get("has_more", 0)) > 0)):
+        if self.numchild > 0 or (self.is_dynamic and self.has_more):
             return True
+        return bool(self.child_count)
 
-        # for dynamic child variables the has_more field is not available so we
-        # have to actually list the children to find out if there are any
-        if self.is_dynamic and self.is_existing():
-            children = parse_result_line(run_cmd("-var-list-children \"%s\"" % self.get_name(), True))
-            return int(children["numchild"]) > 0
+    def needs_child_count(self):
+        return (self.child_count is None and self.is_dynamic and
+                self.numchild == 0 and not self.has_more)
 
-        return False
+    def size(self):
+        return 1 + sum(child.size() for child in self.children)
 
     def collapse(self):
         self.is_expanded = False
@@ -501,36 +973,35 @@ class GDBVariable:
             return "%s %s = (%s) %s" % (type, self['exp'], self['dynamic_type'], self['value'])
 
     def __iter__(self):
-        return self.valuepair.__iter__()
+        return iter([key for key in self.fields if getattr(self, key) is not None])
+
+    def __contains__(self, key):
+        return key in self.fields and getattr(self, key) is not None
 
     def __getitem__(self, key):
-        return self.valuepair[key]
+        if key not in self:
+            raise KeyError(key)
+        return getattr(self, key)
 
     def __setitem__(self, key, value):
-        self.valuepair[key] = value
+        if key not in self.fields:
+            return
+        if key == "numchild" or key == "has_more":
+            value = int(value)
+        elif key != "value" and key != "name":
+            # the same types and member names show up over and over
+            value = sintern(value)
+        setattr(self, key, value)
         if key == "value":
             self.dirty = True
 
+    def __delitem__(self, key):
+        if key in self.fields:
+            setattr(self, key, None)
+
     @property
     def is_dynamic(self):
-        return ('dynamic' in self)
-
-    def update_from(self, var):
-        if (var.is_expanded):
-            self.expand()
-            for child in self.children:
-                otherChild = var.find_child_expression(child["exp"])
-                if (otherChild):
-                    child.update_from(otherChild)
-                else:
-                    child.dirty = True
-        self.dirty = (self["value"] != var["value"])
-
-    def find_child_expression(self, exp):
-        for child in self.children:
-            if (child["exp"] == exp):
-                return child
-        return None
+        return self.dynamic is not None
 
     def clear_dirty(self):
         self.dirty = False
@@ -546,41 +1017,79 @@ class GDBVariable:
                     break
         return dirt
 
-    def format(self, indent="", output="", line=0, dirty=[]):
+    def add_rows(self, rows, more, depth=0):
+        # lists the variables shown on each line, None for a "[more...]" line
+        self.line = len(rows)
+        self.depth = depth
+        rows.append(self)
+        if self.is_expanded:
+            for child in self.children:
+                child.add_rows(rows, more, depth + 1)
+            if self.has_more_children:
+                more[len(rows)] = self
+                rows.append(None)
+
+    def format(self):
         icon = " "
         if self.has_children():
             if self.is_expanded:
                 icon = "-"
             else:
                 icon = "+"
-
-        output += "%s%s%s\n" % (indent, icon, self)
-        self.line = line
-        line = line + 1
-        indent += "    "
-        if self.is_expanded:
-            for child in self.children:
-                output, line = child.format(indent, output, line, dirty)
-        if self.is_dirty():
-            dirty.append(self)
-        return (output, line)
+        return "%s%s%s\n" % ("    " * self.depth, icon, self)
 
     @staticmethod
     def filter_type(type):
+        # apply all user-defined filters
+        return gdb_type_filter.apply(type)
+
+
+class GDBTypeFilter(object):
+    """Applies the type_filters setting to type names.
+
+    The filters are compiled again only when get_setting hands out a new
+    type_filters list, i.e. after the settings changed, and the filtered
+    names are kept in a small LRU cache since the same long template
+    types show up over and over.
+    """
+    def __init__(self, size=4096):
+        self.size = size
+        self.source = None
+        self.filters = []
+        self.cache = collections.OrderedDict()
+
+    def compile(self, filters):
         # use the regex module instead of re if available
-        sub = re.sub
+        compile = re.compile
         try:
             import regex
-            sub = regex.sub
+            compile = regex.compile
         except:
             pass
+        self.filters = [(compile(f["pattern"]), f["replace"]) for f in filters]
+        self.source = filters
+        self.cache.clear()
 
-        # apply all user-defined filters
+    def apply(self, type):
         filters = get_setting("type_filters", [], gdb_variables_view)
-        for f in filters:
-            type = sub(f["pattern"], f["replace"], type)
+        if filters is not self.source and filters != self.source:
+            self.compile(filters)
+        if not self.filters:
+            return type
+        try:
+            filtered = self.cache.pop(type)
+        except KeyError:
+            filtered = type
+            for pattern, replace in self.filters:
+                filtered = pattern.sub(replace, filtered)
+            if len(self.cache) >= self.size:
+                self.cache.popitem(False)
+        self.cache[type] = filtered
+        return filtered
+
+
+gdb_type_filter = GDBTypeFilter()
 
-        return type
 
 def qtod(q):
     val = struct.pack("Q", q)
@@ -590,9 +1099,11 @@ def itof(i):
     val = struct.pack("I", i)
     return struct.unpack("f", val)[0]
 
-class GDBRegister:
+class GDBRegister(object):
+    __slots__ = ("name", "index", "value", "line", "lines")
+
     def __init__(self, name, index, val):
-        self.name = name
+        self.name = sintern(name)
         self.index = index
         self.value = val
         self.line = 0
@@ -645,7 +1156,7 @@ class GDBRegister:
 
     def edit_on_done(self, val):
         self.set_gdb_value(val)
-        gdb_register_view.update_values()
+        gdb_worker.post(gdb_register_view.update_values)
 
     def edit(self):
         sublime.active_window().show_input_panel("$%s =" % self.name, self.value, self.edit_on_done, None, None)
@@ -655,29 +1166,38 @@ class GDBRegisterView(GDBView):
     def __init__(self):
         super(GDBRegisterView, self).__init__("GDB Registers", s=False, settingsprefix="registers")
         self.values = None
+        self.reload = False
 
     def open(self):
         super(GDBRegisterView, self).open()
         self.set_syntax("Packages/SublimeGDB/gdb_registers.tmLanguage")
         self.get_view().settings().set("word_wrap", False)
         if self.is_open() and gdb_run_status == "stopped":
-            self.update_values()
+            gdb_worker.post(self.update_values)
 
     def get_names(self):
         line = run_cmd("-data-list-register-names", True)
-        return parse_result_line(line)["register-names"]
+        return parse_result_line(line, ["register-names"])["register-names"]
 
     def get_values(self):
         line = run_cmd("-data-list-register-values x", True)
         if get_result(line) != "done":
             return []
-        return parse_result_line(line)["register-values"]
+        return parse_result_line(line, ["register-values"])["register-values"]
+
+    def refresh(self):
+        self.update_values()
 
     def update_values(self):
         if not self.should_update():
             return
+        if self.defer_update():
+            # the changed registers are only reported for the last stop
+            self.reload = True
+            return
         dirtylist = []
-        if self.values is None:
+        if self.values is None or self.reload:
+            self.reload = False
             names = self.get_names()
             vals = self.get_values()
             self.values = []
@@ -686,32 +1206,25 @@ class GDBRegisterView(GDBView):
                 idx = int(vals[i]["number"])
                 self.values.append(GDBRegister(names[idx], idx, vals[i]["value"]))
         else:
-            dirtylist = regs = parse_result_line(run_cmd("-data-list-changed-registers", True))["changed-registers"]
-            regvals = parse_result_line(run_cmd("-data-list-register-values x %s" % " ".join(regs), True))["register-values"]
+            dirtylist = regs = parse_result_line(run_cmd("-data-list-changed-registers", True), ["changed-registers"])["changed-registers"]
+            regvals = parse_result_line(run_cmd("-data-list-register-values x %s" % " ".join(regs), True), ["register-values"])["register-values"]
             for i in range(len(regs)):
                 reg = int(regvals[i]["number"])
                 if reg < len(self.values):
                     self.values[reg].set_value(regvals[i]["value"])
-        pos = self.get_view().viewport_position()
-        self.clear()
+        output = []
         line = 0
         for item in self.values:
-            output, line = item.format(line)
-            self.add_line(output)
-        self.set_viewport_position(pos)
-        self.update()
+            text, line = item.format(line)
+            output.append(text)
+        self.replace("".join(output))
         regions = []
-        v = self.get_view()
         for dirty in dirtylist:
             i = int(dirty)
             if i >= len(self.values):
                 continue
-            region = v.full_line(v.text_point(self.values[i].line, 0))
-            if self.values[i].lines > 1:
-                region = region.cover(v.full_line(v.text_point(self.values[i].line + self.values[i].lines - 1, 0)))
-
-            regions.append(region)
-        v.add_regions("sublimegdb.dirtyregisters", regions,
+            regions.append((self.values[i].line, self.values[i].lines))
+        self.add_line_regions("sublimegdb.dirtyregisters", regions,
                         get_setting("changed_variable_scope", "entity.name.class"),
                         get_setting("changed_variable_icon", ""),
                         sublime.DRAW_OUTLINED)
@@ -731,149 +1244,370 @@ class GDBVariablesView(GDBView):
     def __init__(self):
         super(GDBVariablesView, self).__init__("GDB Variables", False, settingsprefix="variables")
         self.variables = []
+        # every varobj shown in the view, including children, by name
+        self.varobjs = {}
+        # the line each symbol of the current frame was declared on
+        self.declarations = {}
+        # the variable each "[more...]" line lists more children of
+        self.more_lines = {}
+        # the variable shown on each line, and the lines that are filled in
+        self.rows = []
+        self.window = (0, 0)
+        # whether check_viewport is polling for scrolling and whether it has
+        # asked for the lines scrolled to to be filled in
+        self.watching = False
+        self.rerender = False
+        # the frame the variables belong to, and the frozen variables of the
+        # frames that were left, least recently used first
+        self.frame = None
+        self.frame_cache = collections.OrderedDict()
+        # the number of frames on the stack, as of the last get_frame_key
+        self.stack_depth = 0
+        # whether all the stops skipped while hidden were in the same frame
+        self.stale_same_frame = True
 
     def open(self):
         super(GDBVariablesView, self).open()
         self.set_syntax("Packages/C++/C++.tmLanguage")
         if self.is_open() and gdb_run_status == "stopped":
-            self.update_variables(False)
+            gdb_worker.post(self.update_variables, False)
 
     def update_view(self):
-        self.clear()
-        output = ""
-        line = 0
-        dirtylist = []
+        self.rerender = False
+        rows = []
+        more = {}
         for local in self.variables:
-            output, line = local.format(line=line, dirty=dirtylist)
-            self.add_line(output)
-        self.update()
-        regions = []
-        v = self.get_view()
-        for dirty in dirtylist:
-            regions.append(v.full_line(v.text_point(dirty.line, 0)))
-        v.add_regions("sublimegdb.dirtyvariables", regions,
+            local.add_rows(rows, more)
+        # only the lines around the visible ones are filled in, the rest are
+        # left empty until they're scrolled to
+        first, last = self.get_render_window(len(rows))
+        # formatting must not need gdb, so look up what it will need first
+        self.fetch_child_counts([var for var in rows[first:last] if var is not None])
+        output = []
+        dirtylist = []
+        for line in range(len(rows)):
+            var = rows[line]
+            if line < first or line >= last:
+                output.append("\n")
+            elif var is None:
+                output.append("%s [more...]\n" % ("    " * (more[line].depth + 1)))
+            else:
+                output.append(var.format())
+                if var.is_dirty():
+                    dirtylist.append(var)
+        self.rows = rows
+        self.more_lines = more
+        self.window = (first, last)
+        self.replace("".join(output))
+        self.add_line_regions("sublimegdb.dirtyvariables", [(dirty.line, 1) for dirty in dirtylist],
                         get_setting("changed_variable_scope", "entity.name.class"),
                         get_setting("changed_variable_icon", ""),
                         sublime.DRAW_OUTLINED)
+        if not self.watching:
+            self.watching = True
+            sublime.set_timeout(self.check_viewport, 100)
+
+    def get_viewport(self):
+        # the first and last line shown
+        view = self.get_view()
+        if view is None:
+            return (0, 0)
+        region = view.visible_region()
+        return (view.rowcol(region.begin())[0], view.rowcol(region.end())[0])
+
+    def get_render_window(self, count):
+        margin = get_setting("variables_render_margin", 200)
+        if margin <= 0:
+            return (0, count)
+        top, bottom = self.get_viewport()
+        return (max(0, top - margin), min(count, bottom + margin + 1))
+
+    def check_viewport(self):
+        if not self.is_open() or not self.rows:
+            self.watching = False
+            return
+        if self.should_update() and self.is_visible() and not self.rerender:
+            first, last = self.window
+            top, bottom = self.get_viewport()
+            margin = get_setting("variables_render_margin", 200) // 2
+            if (first > 0 and top - margin < first) or (last < len(self.rows) and bottom + margin >= last):
+                self.rerender = True
+                gdb_worker.post(self.fill_in_view)
+        sublime.set_timeout(self.check_viewport, 100)
+
+    def fill_in_view(self):
+        # the program may have been continued since check_viewport posted this
+        if self.should_update():
+            self.update_view()
+        else:
+            self.rerender = False
 
     def extract_varnames(self, res):
         if "name" in res:
-            return listify(res["name"])
+            return res.getlist("name")
         elif len(res) > 0 and isinstance(res, list):
             if "name" in res[0]:
                 return [x["name"] for x in res]
         return []
 
-    def add_variable(self, exp):
-        v = self.create_variable(exp)
-        if v:
-            self.variables.append(v)
+    def add_variables(self, exps):
+        for v in self.create_variables(exps):
+            if v:
+                self.variables.append(v)
+                self.track(v)
+
+    def get_declaration_line(self, exp):
+        if exp not in self.declarations:
+            self.fetch_declaration_lines([exp])
+        return self.declarations.get(exp)
+
+    def fetch_declaration_lines(self, exps):
+        # kept until the frame changes
+        exps = [exp for exp in exps if exp not in self.declarations]
+        if not exps:
+            return
+        lines = []
+        output = run_python_cmd("python print(' '.join([str(gdb.lookup_symbol(n)[0].line) if gdb.lookup_symbol(n)[0] else '-' for n in %r]))" % exps, True)
+        for line in output.split():
+            try:
+                lines.append(int(line))
+            except:
+                # "-", there is no such symbol
+                lines.append(None)
+        if len(lines) != len(exps):
+            # the command failed, so ask again next time
+            return
+        self.declarations.update(zip(exps, lines))
+
+    def fetch_child_counts(self, variables):
+        # for dynamic variables the has_more field is not always available so
+        # we have to actually list the children to find out if there are any,
+        # only the first one is listed as that's enough to tell
+        variables = [var for var in variables if var.needs_child_count()]
+        self.fetch_declaration_lines([var["exp"] for var in variables if not var.parent])
+        variables = [var for var in variables if var.is_existing()]
+        lines = run_cmds(["-var-list-children \"%s\" 0 1" % var.get_name() for var in variables])
+        for var, line in zip(variables, lines):
+            # left unknown when listing failed, so it's tried again
+            if get_result(line, False) == "done":
+                res = parse_result_line(line, ["numchild", "has_more"])
+                var.child_count = int(res["numchild"]) + int(res.get("has_more", 0))
+
+    def track(self, var):
+        self.varobjs[var.get_name()] = var
+        for child in var.children:
+            self.track(child)
+
+    def untrack(self, var):
+        self.varobjs.pop(var.get_name(), None)
+        for child in var.children:
+            self.untrack(child)
 
     def create_variable(self, exp, show_error = True):
-        line = run_cmd("-var-create - * %s" % exp, True)
-        if get_result(line, False) == "error" and "&" in exp:
-            line = run_cmd("-var-create - * %s" % exp.replace("&", ""), True)
-        if get_result(line, show_error) == "error":
+        return self.create_variables([exp], show_error)[0]
+
+    def create_variables(self, exps, show_error = True):
+        lines = run_cmds(["-var-create - * %s" % exp for exp in exps])
+        variables = []
+        for exp, line in zip(exps, lines):
+            if get_result(line, False) == "error" and "&" in exp:
+                line = run_cmd("-var-create - * %s" % exp.replace("&", ""), True)
+            if get_result(line, show_error) == "error":
+                variables.append(None)
+                continue
+            var = parse_result_line(line)
+            var['exp'] = exp
+            variables.append(GDBVariable(var))
+        return variables
+
+    def get_frame_key(self):
+        # The frame is told apart by its function and how far it is from the
+        # outermost frame, which doesn't change while it is on the stack.
+        depth = run_cmd("-stack-info-depth", True)
+        if get_result(depth, False) != "done" or gdb_stack_frame is None:
             return None
-        var = parse_result_line(line)
-        var['exp'] = exp
-        return GDBVariable(var)
+        self.stack_depth = int(parse_result_line(depth, ["depth"])["depth"])
+        return (gdb_stack_frame.get("func"), gdb_stack_frame.get("fullname", gdb_stack_frame.get("shlibname")),
+                self.stack_depth - gdb_stack_index)
+
+    def cache_frame(self):
+        if self.frame is None or not self.variables:
+            self.delete_variables(self.variables)
+            return
+        # frozen varobjs are skipped by -var-update * until they're thawed
+        write_cmds(["-var-set-frozen %s 1" % var.get_name() for var in self.variables])
+        for var in self.variables:
+            self.untrack(var)
+        self.frame_cache[self.frame] = (self.variables, sum(var.size() for var in self.variables))
+        limit = get_setting("variables_cache_size", 5000)
+        size = sum(count for variables, count in self.frame_cache.values())
+        while size > limit:
+            frame, (variables, count) = self.frame_cache.popitem(False)
+            self.delete_variables(variables)
+            size -= count
+
+    def restore_frame(self, frame):
+        if frame is None:
+            return False
+        # frames further from the outermost one than the innermost frame on
+        # the stack have returned since they were left. Frames between it and
+        # the selected one are still there and are kept.
+        for key in [key for key in self.frame_cache if key[2] > self.stack_depth]:
+            self.delete_variables(self.frame_cache.pop(key)[0])
+        if frame not in self.frame_cache:
+            return False
+        self.variables = self.frame_cache.pop(frame)[0]
+        write_cmds(["-var-set-frozen %s 0" % var.get_name() for var in self.variables])
+        for var in self.variables:
+            self.track(var)
+        return True
+
+    def on_session_ended(self):
+        super(GDBVariablesView, self).on_session_ended()
+        # the varobjs went away with gdb
+        self.variables = []
+        self.varobjs = {}
+        self.rows = []
+        self.more_lines = {}
+        self.frame = None
+        self.frame_cache.clear()
+
+    def delete_variables(self, variables):
+        if variables and is_running():
+            write_cmds(["-var-delete %s" % var.get_name() for var in variables])
+        for var in variables:
+            var.deleted = True
+            self.untrack(var)
+
+    def refresh(self):
+        sameFrame = self.stale_same_frame
+        self.stale_same_frame = True
+        self.update_variables(sameFrame)
 
     def update_variables(self, sameFrame):
         if not self.should_update():
             return
+        if self.defer_update():
+            self.stale_same_frame = self.stale_same_frame and sameFrame
+            return
+        if not sameFrame:
+            frame = self.get_frame_key()
+            if frame != self.frame or frame is None:
+                self.cache_frame()
+                self.variables = []
+                self.varobjs = {}
+                self.declarations = {}
+                self.frame = frame
+                # a frame that was left before only needs updating
+                sameFrame = self.restore_frame(frame)
         if sameFrame:
-            variables = []
-            for var in self.variables:    # completely replace dynamic variables because we don't always get proper update notifications
-                if (var.is_dynamic):
-                    var.delete()
-                    newVar = self.create_variable(var['exp'], False)
-                    if (newVar):    # may have gone out of scope without notification
-                        newVar.update_from(var)
-                        variables.append(newVar)
-                else:
-                    var.clear_dirty()
-                    variables.append(var)
-            self.variables = variables
-            ret = parse_result_line(run_cmd("-var-update --all-values *", True))["changelist"]
+            for var in self.variables:
+                var.clear_dirty()
+            update, local_list = run_cmds(["-var-update --all-values *", "-stack-list-locals 0"])
+            ret = parse_result_line(update, ["changelist"])["changelist"]
             if "varobj" in ret:
-                ret = listify(ret["varobj"])
-            dellist = []
+                ret = ret.getlist("varobj")
+            dellist = set()
             for value in ret:
-                name = value["name"]
-                for var in self.variables:
-                    real = var.find(name)
-                    if (real is not None):
-                        if  "in_scope" in value and value["in_scope"] == "false":
-                            real.delete()
-                            dellist.append(real)
-                            continue
-                        if (not real.is_dynamic):
-                            real.update(value)
-                            if not "value" in value and not "new_value" in value:
-                                real.update_value()
-                        break
-            for item in dellist:
-                self.variables.remove(item)
+                real = self.varobjs.get(value["name"])
+                if real is None or real.deleted:
+                    continue
+                if "new_num_children" in value or "has_more" in value or "new_children" in value:
+                    real.child_count = None
+                if "in_scope" in value and value["in_scope"] in ("false", "invalid"):
+                    real.delete()
+                    self.untrack(real)
+                    dellist.add(real)
+                    continue
+                # the children gdb has for the varobj don't match ours any more
+                reload = (value.get("type_changed") == "true" or "new_children" in value or
+                          (real.is_dynamic and int(value.get("new_num_children", real.next_child)) < real.next_child))
+                value.pop("new_children", None)
+                real.update(value)
+                if not "value" in value and not "new_value" in value:
+                    real.update_value()
+                if reload:
+                    self.reload_children(real)
+                elif real.is_dynamic and real.next_child > 0 and "has_more" in value:
+                    real.has_more_children = int(value["has_more"]) > 0
+            if dellist:
+                self.variables = [var for var in self.variables if var not in dellist]
             if len(self.variables) == 0:
                 # Is it really the same frame? Seems everything was removed, so might as well pull all data again
                 sameFrame = False
             else:
-                loc = self.extract_varnames(parse_result_line(run_cmd("-stack-list-locals 0", True))["locals"])
-                tracked = []
+                loc = self.extract_varnames(parse_result_line(local_list, ["locals"])["locals"])
+                untracked = collections.Counter(var['exp'] for var in self.variables)
+                create = []
                 for var in loc:
-                    create = True
-                    for var2 in self.variables:
-                        if var2['exp'] == var and var2 not in tracked:
-                            tracked.append(var2)
-                            create = False
-                            break
-                    if create:
-                        self.add_variable(var)
+                    if untracked[var] > 0:
+                        untracked[var] -= 1
+                    else:
+                        create.append(var)
+                self.add_variables(create)
 
         if not sameFrame:
-            for var in self.variables:
-                var.delete()
-            args = self.extract_varnames(parse_result_line(run_cmd("-stack-list-arguments 0 %d %d" % (gdb_stack_index, gdb_stack_index), True))["stack-args"]["frame"]["args"])
+            self.delete_variables(self.variables)
+            self.varobjs = {}
+            args, local_list = run_cmds(["-stack-list-arguments 0 %d %d" % (gdb_stack_index, gdb_stack_index), "-stack-list-locals 0"])
+            args = self.extract_varnames(parse_result_line(args, ["stack-args.frame.args"])["stack-args"]["frame"]["args"])
+            loc = self.extract_varnames(parse_result_line(local_list, ["locals"])["locals"])
             self.variables = []
-            for arg in args:
-                self.add_variable(arg)
-            loc = self.extract_varnames(parse_result_line(run_cmd("-stack-list-locals 0", True))["locals"])
-            for var in loc:
-                self.add_variable(var)
+            self.add_variables(args + loc)
         self.update_view()
 
-    def get_variable_at_line(self, line, var_list=None):
-        if var_list is None:
-            var_list = self.variables
-        if len(var_list) == 0:
-            return None
-
-        for i in range(len(var_list)):
-            if var_list[i].line == line:
-                return var_list[i]
-            elif var_list[i].line > line:
-                return self.get_variable_at_line(line, var_list[i - 1].children)
-        return self.get_variable_at_line(line, var_list[len(var_list) - 1].children)
+    def get_variable_at_line(self, line):
+        if 0 <= line < len(self.rows):
+            return self.rows[line]
+        return None
 
     def expand_collapse_variable(self, view, expand=True, toggle=False):
         row, col = view.rowcol(view.sel()[0].a)
         if self.is_open() and view.id() == self.get_view().id():
-            var = self.get_variable_at_line(row)
-            if var and var.has_children():
-                if toggle:
-                    if var.is_expanded:
-                        var.collapse()
-                    else:
-                        var.expand()
-                elif expand:
-                    var.expand()
+            gdb_worker.post(self.expand_collapse_row, row, expand, toggle)
+
+    def expand_collapse_row(self, row, expand, toggle):
+        if row in self.more_lines:
+            if not expand and not toggle:
+                return
+            var = self.more_lines[row]
+            var.load_more_children()
+            self.track(var)
+            self.update_view()
+            return
+        var = self.get_variable_at_line(row)
+        if var and var.has_children():
+            if toggle:
+                if var.is_expanded:
+                    self.collapse_variable(var)
                 else:
-                    var.collapse()
-                pos = view.viewport_position()
-                self.update_view()
-                self.set_viewport_position(pos)
-                self.update()
+                    var.expand()
+            elif expand:
+                var.expand()
+            else:
+                self.collapse_variable(var)
+            self.track(var)
+            self.update_view()
+
+    def reload_children(self, var):
+        loaded = var.next_child
+        for child in var.children:
+            self.untrack(child)
+        var.delete_children()
+        var.child_count = None
+        if var.is_expanded:
+            var.expand()
+            while var.has_more_children and var.next_child < loaded:
+                var.load_more_children()
+        self.track(var)
+
+    def collapse_variable(self, var):
+        var.collapse()
+        # don't hold on to more than a page of children while they're hidden
+        if var.next_child > get_setting("variables_page_size", 100):
+            for child in var.children:
+                self.untrack(child)
+            var.delete_children()
 
 
 class GDBCallstackFrame:
@@ -906,37 +1640,39 @@ class GDBCallstackView(GDBView):
         super(GDBCallstackView, self).open()
         self.set_syntax("Packages/C++/C++.tmLanguage")
         if self.is_open() and gdb_run_status == "stopped":
-            self.update_callstack()
+            gdb_worker.post(self.update_callstack)
+
+    def refresh(self):
+        self.update_callstack()
 
     def update_callstack(self):
-        if not self.should_update():
+        if not self.should_update() or self.defer_update():
             return
         global gdb_cursor_position
-        line = run_cmd("-stack-list-frames", True)
+        line, args = run_cmds(["-stack-list-frames", "-stack-list-arguments 1"])
         if get_result(line) == "error":
             gdb_cursor_position = 0
-            update_view_markers()
+            sublime.set_timeout(update_view_markers, 0)
             return
-        frames = listify(parse_result_line(line)["stack"]["frame"])
-        args = listify(parse_result_line(run_cmd("-stack-list-arguments 1", True))["stack-args"]["frame"])
-        pos = self.get_view().viewport_position()
-        self.clear()
+        frames = parse_result_line(line, ["stack.frame.func"])["stack"].getlist("frame")
+        args = parse_result_line(args, ["stack-args.frame.args"])["stack-args"].getlist("frame")
 
-        self.frames = []
+        output = []
+        callstack = []
         for i in range(len(frames)):
             arg = {}
             if len(args) > i:
                 arg = args[i]["args"]
             f = GDBCallstackFrame(frames[i]["func"], arg)
-            self.frames.append(f)
-            self.add_line(f.format())
-        self.set_viewport_position(pos)
-        self.update()
+            callstack.append(f)
+            output.append(f.format())
+        self.frames = callstack
+        self.replace("".join(output))
 
     def update_marker(self, pos_scope, pos_icon):
         if self.is_open():
             view = self.get_view()
-            if gdb_stack_index != -1:
+            if gdb_stack_index != -1 and not self.stale:
                 line = 0
                 for i in range(gdb_stack_index):
                     line += self.frames[i].lines
@@ -952,11 +1688,14 @@ class GDBCallstackView(GDBView):
         for i in range(len(self.frames)):
             fl = self.frames[i].lines
             if row <= line + fl - 1:
-                run_cmd("-stack-select-frame %d" % i)
-                update_cursor()
+                gdb_worker.post(self.select_frame, i)
                 break
             line += fl
 
+    def select_frame(self, index):
+        run_cmd("-stack-select-frame %d" % index)
+        update_cursor()
+
 
 class GDBThread:
     def __init__(self, id, state="UNKNOWN", func="???()", details=None):
@@ -982,31 +1721,35 @@ class GDBThreadsView(GDBView):
         super(GDBThreadsView, self).open()
         self.set_syntax("Packages/C++/C++.tmLanguage")
         if self.is_open() and gdb_run_status == "stopped":
-            self.update_threads()
+            gdb_worker.post(self.update_threads)
+
+    def refresh(self):
+        self.update_threads()
 
     def update_threads(self):
-        if not self.should_update():
+        if not self.should_update() or self.defer_update():
             return
-        res = run_cmd("-thread-info", True)
-        ids = parse_result_line(run_cmd("-thread-list-ids", True))
+        res, ids = run_cmds(["-thread-info", "-thread-list-ids"])
+        threads = []
+        ids = parse_result_line(ids)
         if get_result(res) == "error":
             if "thread-ids" in ids and "thread-id" in ids["thread-ids"]:
-                self.threads = [GDBThread(int(id)) for id in ids["thread-ids"]["thread-id"]]
+                threads = [GDBThread(int(id)) for id in ids["thread-ids"].getlist("thread-id")]
                 if "threads" in ids and "thread" in ids["threads"]:
-                    for thread in ids["threads"]["thread"]:
+                    for thread in ids["threads"].getlist("thread"):
                         if "thread-id" in thread and "state" in thread:
                             tid = int(thread["thread-id"])
-                            for t2 in self.threads:
+                            for t2 in threads:
                                 if t2.id == tid:
                                     t2.state = thread["state"]
                                     break
                 else:
                     l = parse_result_line(run_cmd("-thread-info", True))
             else:
-                self.threads = []
+                threads = []
         else:
             l = parse_result_line(res)
-            self.threads = []
+            threads = []
             for thread in l["threads"]:
                 func = "???"
                 if "frame" in thread and "func" in thread["frame"]:
@@ -1022,17 +1765,13 @@ class GDBThreadsView(GDBView):
                                 args += " = " + arg["value"]
                     func = "%s(%s);" % (func, args)
                 log_debug("thread %s" % thread)
-                self.threads.append(GDBThread(int(thread["id"]), thread["state"], func, thread.get("details")))
+                threads.append(GDBThread(int(thread["id"]), thread["state"], func, thread.get("details")))
 
         if "current-thread-id" in ids:
             self.current_thread = int(ids["current-thread-id"])
-        pos = self.get_view().viewport_position()
-        self.clear()
-        self.threads.sort(key=lambda t: t.id)
-        for thread in self.threads:
-            self.add_line(thread.format())
-        self.set_viewport_position(pos)
-        self.update()
+        threads.sort(key=lambda t: t.id)
+        self.threads = threads
+        self.replace("".join([thread.format() for thread in threads]))
 
     def update_marker(self, pos_scope, pos_icon):
         if self.is_open():
@@ -1071,48 +1810,58 @@ class GDBDisassemblyView(GDBView):
         self.set_syntax("Packages/SublimeGDB/gdb_disasm.tmLanguage")
         self.get_view().settings().set("word_wrap", False)
         if self.is_open() and gdb_run_status == "stopped":
-            self.update_disassembly()
+            gdb_worker.post(self.update_disassembly)
 
     def clear(self):
         super(GDBDisassemblyView, self).clear()
         self.start = -1
         self.end = -1
 
-    def add_insns(self, src_asm):
+    def add_insns(self, output, src_asm):
         for asm in src_asm:
             line = "%s: %s" % (asm["address"], asm["inst"])
             if "func-name" in asm:
-                self.add_line("%-80s # %s+%s\n" % (line, asm["func-name"], asm["offset"]))
+                output.append("%-80s # %s+%s\n" % (line, asm["func-name"], asm["offset"]))
             else:
-                self.add_line("%s\n" % line)
+                output.append("%s\n" % line)
             addr = int(asm["address"], 16)
             if self.start == -1 or addr < self.start:
                 self.start = addr
             self.end = addr
 
+    def refresh(self):
+        self.update_disassembly()
+
     def update_disassembly(self):
-        if not self.should_update():
+        if not self.should_update() or self.defer_update():
             return
-        pc = parse_result_line(run_cmd("-data-evaluate-expression $pc", True))["value"]
+        pc = parse_result_line(run_cmd("-data-evaluate-expression $pc", True), ["value"])["value"]
         if " " in pc:
             pc = pc[:pc.find(" ")]
         pc = int(pc, 16)
         if not (pc >= self.start and pc <= self.end):
             l = run_cmd("-data-disassemble -s \"$pc-32\" -e \"$pc+200\" -- 1", True)
             asms = parse_result_line(l)
-            self.clear()
+            self.start = -1
+            self.end = -1
+            output = []
             if get_result(l) != "error":
                 asms = asms["asm_insns"]
                 if "src_and_asm_line" in asms:
-                    l = listify(asms["src_and_asm_line"])
+                    l = asms.getlist("src_and_asm_line")
                     for src_asm in l:
                         line = src_asm["line"]
                         file = src_asm["file"]
-                        self.add_line("%s:%s\n" % (file, line))
-                        self.add_insns(src_asm["line_asm_insn"])
+                        output.append("%s:%s\n" % (file, line))
+                        self.add_insns(output, src_asm["line_asm_insn"])
                 else:
-                    self.add_insns(asms)
-            self.update()
+                    self.add_insns(output, asms)
+            self.replace("".join(output))
+        if self.is_open():
+            self.queue.put((self.do_mark_pc, pc))
+            sublime.set_timeout(self.update, 0)
+
+    def do_mark_pc(self, pc):
         view = self.get_view()
         reg = view.find("^0x[0]*%x:" % pc, 0)
         if reg is None:
@@ -1179,24 +1928,29 @@ class GDBBreakpoint(object):
             self.resolved_filename = self.original_filename
         self.number = int(bp["number"].split(".")[0])
 
-    def insert(self):
-        # TODO: does removing the unicode-escape break things? what's the proper way to handle this in python3?
-        # cmd = "-break-insert \"\\\"%s\\\":%d\"" % (self.original_filename.encode("unicode-escape"), self.original_line)
+    def get_break_cmd(self):
         break_cmd = "-break-insert"
         if get_setting("debug_ext") == True:
             break_cmd += " -f"
+        return break_cmd
+
+    def get_insert_cmd(self):
+        # TODO: does removing the unicode-escape break things? what's the proper way to handle this in python3?
+        # cmd = "-break-insert \"\\\"%s\\\":%d\"" % (self.original_filename.encode("unicode-escape"), self.original_line)
         if self.addr != "":
-            cmd = "%s *%s" % (break_cmd, self.addr)
-        else:
-            cmd = "%s \"\\\"%s\\\":%d\"" % (break_cmd, self.original_filename.replace("\\", "/"), self.original_line)
-        out = run_cmd(cmd, True)
+            return "%s *%s" % (self.get_break_cmd(), self.addr)
+        return "%s \"\\\"%s\\\":%d\"" % (self.get_break_cmd(), self.original_filename.replace("\\", "/"), self.original_line)
+
+    def insert(self):
+        self.inserted(run_cmd(self.get_insert_cmd(), True))
+
+    def inserted(self, out):
         if get_result(out) == "error":
             return
         res = parse_result_line(out)
         if "bkpt" not in res and "matches" in res:
-            for match in res["matches"]["b"]:
-                cmd = "%s *%s" % (break_cmd, match["addr"])
-                out = run_cmd(cmd, True)
+            cmds = ["%s *%s" % (self.get_break_cmd(), match["addr"]) for match in res["matches"].getlist("b")]
+            for out in run_cmds(cmds):
                 if get_result(out) == "error":
                     return
                 res = parse_result_line(out)
@@ -1227,8 +1981,10 @@ class GDBWatch(GDBBreakpoint):
         self.exp = exp
         super(GDBWatch, self).__init__(None, -1)
 
-    def insert(self):
-        out = run_cmd("-break-watch %s" % self.exp, True)
+    def get_insert_cmd(self):
+        return "-break-watch %s" % self.exp
+
+    def inserted(self, out):
         res = parse_result_line(out)
         if get_result(out) == "error":
             return
@@ -1367,21 +2123,21 @@ class GDBBreakpointView(GDBView):
 
     def sync_breakpoints(self):
         global breakpoints
-        for bkpt in self.breakpoints:
-            bkpt.add()
+        if is_running():
+            res = wait_until_stopped()
+            outs = run_cmds([bkpt.get_insert_cmd() for bkpt in self.breakpoints])
+            for bkpt, out in zip(self.breakpoints, outs):
+                bkpt.inserted(out)
+            if res:
+                resume()
         update_view_markers()
         self.update_view()
 
     def update_view(self):
         if not self.is_open():
             return
-        pos = self.get_view().viewport_position()
-        self.clear()
         self.breakpoints.sort(key=lambda b: (b.number, b.filename or "", b.line))
-        for bkpt in self.breakpoints:
-            self.add_line(bkpt.format())
-        self.set_viewport_position(pos)
-        self.update()
+        self.replace("".join([bkpt.format() for bkpt in self.breakpoints]))
 
 
 class GDBSessionView(GDBView):
@@ -1403,6 +2159,142 @@ gdb_threads_view = GDBThreadsView()
 gdb_breakpoint_view = GDBBreakpointView()
 gdb_views = [gdb_session_view, gdb_console_view, gdb_variables_view, gdb_callstack_view, gdb_register_view, gdb_disassembly_view, gdb_threads_view, gdb_breakpoint_view]
 
+
+def format_count(n):
+    if n >= 1000000:
+        return "%.1fM" % (n / 1000000.0)
+    if n >= 1000:
+        return "%.1fk" % (n / 1000.0)
+    return "%d" % n
+
+
+class GDBProgramOutput(object):
+    """Passes the program's output on to the console view.
+
+    At most program_output_rate lines a second are shown, the rest are
+    counted and summarized so that a program flooding its output can't
+    bog down the editor. With program_output_spool everything is also
+    written to a file that "Show Program Output" opens the end of. Once
+    that file is larger than program_output_spool_max_size only its last
+    program_output_tail_size bytes are kept.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spool = None
+        self.spool_name = None
+        self.spool_size = 0
+        self.spool_max_size = 0
+        self.tail_size = 0
+        self.rate = 0
+        self.window_start = 0
+        self.window_lines = 0
+        self.suppressed = 0
+
+    def start(self):
+        # throws away the previous session's output
+        self.remove()
+        with self.lock:
+            self.rate = get_setting("program_output_rate", 1000)
+            self.window_start = 0
+            self.window_lines = 0
+            self.suppressed = 0
+            if get_setting("program_output_spool", True):
+                fd, self.spool_name = tempfile.mkstemp(prefix="sublimegdb-", suffix=".log")
+                # written as utf-8 bytes, whatever the locale's encoding is
+                self.spool = os.fdopen(fd, "wb")
+                self.spool_size = 0
+                self.spool_max_size = get_setting("program_output_spool_max_size", 104857600)
+                self.tail_size = get_setting("program_output_tail_size", 1048576)
+
+    def add(self, text):
+        with self.lock:
+            if self.spool is not None:
+                data = text if isinstance(text, bytes) else text.encode("utf-8", "replace")
+                self.spool.write(data)
+                self.spool_size += len(data)
+                if self.spool_max_size > 0 and self.spool_size > self.spool_max_size:
+                    self.trim_spool()
+            if self.rate <= 0:
+                gdb_console_view.add_line(text)
+                return
+            self.next_window()
+            allowed = self.rate - self.window_lines
+            lines = text.count("\n")
+            if lines <= allowed:
+                self.window_lines += lines
+                gdb_console_view.add_line(text)
+                return
+            if allowed > 0:
+                end = 0
+                for i in range(allowed):
+                    end = text.index("\n", end) + 1
+                gdb_console_view.add_line(text[:end])
+            self.window_lines = self.rate
+            self.suppressed += lines - allowed
+
+    def trim_spool(self):
+        # keeps only the part "Show Program Output" would show
+        self.spool.flush()
+        with open(self.spool_name, "rb") as f:
+            f.seek(-min(self.tail_size, self.spool_size), os.SEEK_END)
+            tail = f.read()
+        self.spool.seek(0)
+        self.spool.truncate()
+        self.spool.write(tail)
+        self.spool_size = len(tail)
+
+    def next_window(self):
+        # starts counting again once a second has passed, telling the user
+        # about what was suppressed in the last one
+        now = time.time()
+        if now - self.window_start < 1:
+            return
+        self.window_start = now
+        self.window_lines = 0
+        if self.suppressed > 0:
+            more = ""
+            if self.spool is not None:
+                more = ", see \"SublimeGDB: Show Program Output\""
+            gdb_console_view.add_line("... %s lines suppressed%s ...\n" % (format_count(self.suppressed), more))
+            self.suppressed = 0
+
+    def flush(self):
+        # called when the program is idle, so a summary doesn't wait for
+        # more output to show up
+        with self.lock:
+            self.next_window()
+            if self.spool is not None:
+                self.spool.flush()
+
+    def close(self):
+        with self.lock:
+            self.window_start = 0
+            self.next_window()
+            if self.spool is not None:
+                self.spool.close()
+                self.spool = None
+
+    def remove(self):
+        self.close()
+        with self.lock:
+            if self.spool_name is not None:
+                try:
+                    os.remove(self.spool_name)
+                except OSError:
+                    pass
+                self.spool_name = None
+
+
+gdb_program_output = GDBProgramOutput()
+
+
+def plugin_unloaded():
+    # don't leave the saved program output behind in the temp directory
+    gdb_program_output.remove()
+
+# the Sublime Text 2 name for it
+unload_handler = plugin_unloaded
+
 def update_view_markers(view=None):
     if view is None:
         view = sublime.active_window().active_view()
@@ -1427,10 +2319,95 @@ def update_view_markers(view=None):
     gdb_breakpoint_view.update_marker(view)
 
 count = 0
+# Serializes writes to gdb's stdin so that tokens are sent in order
+gdb_command_lock = threading.Lock()
+# Commands waiting for their result record, by token
+gdb_pending_commands = {}
+gdb_pending_lock = threading.Lock()
+
+
+class PendingCommand(object):
+    """An MI command that has been sent to gdb but not yet answered."""
+    __slots__ = ("token", "cmd", "event", "result")
+
+    def __init__(self, token, cmd):
+        self.token = token
+        self.cmd = cmd
+        self.event = threading.Event()
+        self.result = None
+
+    def set_result(self, line):
+        self.result = line
+        self.event.set()
+
+    def wait(self, timeout, deadline=None):
+        # with a deadline only the time left until it is waited for, timeout
+        # is what the whole wait was given
+        if deadline is not None:
+            self.event.wait(max(0, deadline - time.time()))
+        else:
+            self.event.wait(timeout)
+        if self.result is None:
+            with gdb_pending_lock:
+                gdb_pending_commands.pop(self.token, None)
+            raise ValueError("Command \"%s\" took longer than %d seconds to perform?" % (self.cmd, timeout))
+        return self.result
+
+
+def write_cmds(cmds, mimode=True, pending=False):
+    """Sends all of cmds to gdb in one write and returns a (token,
+    PendingCommand) pair for each of them. The PendingCommand is only
+    created if pending is True."""
+    global count
+    with gdb_command_lock:
+        lines = []
+        ret = []
+        for cmd in cmds:
+            if mimode:
+                count = count + 1
+                token = count
+                cmd = "%d%s\n" % (count, cmd)
+            else:
+                token = count
+                cmd = "%s\n\n" % cmd
+            result = None
+            if pending and mimode:
+                # registered before writing so the reader can't see the result first
+                result = PendingCommand(token, cmd)
+                with gdb_pending_lock:
+                    gdb_pending_commands[token] = result
+            lines.append(cmd)
+            ret.append((token, result))
+        data = "".join(lines)
+        log_debug(data)
+
+        if gdb_session_view is not None:
+            gdb_session_view.add_line(data)
+        gdb_process.stdin.write(data.encode(sys.getdefaultencoding()))
+        gdb_process.stdin.flush()
+    return ret
+
+
+def write_cmd(cmd, mimode=True, pending=False):
+    return write_cmds([cmd], mimode, pending)[0]
+
+
+def complete_cmd(token, line):
+    with gdb_pending_lock:
+        pending = gdb_pending_commands.pop(token, None)
+    if pending is not None:
+        pending.set_result(line)
+
+
+def cancel_pending_cmds():
+    with gdb_pending_lock:
+        pending = list(gdb_pending_commands.values())
+        gdb_pending_commands.clear()
+    for p in pending:
+        p.set_result("%d^error,msg=\"no session running\"" % p.token)
 
 
 def run_cmd(cmd, block=False, mimode=True, timeout=None):
-    global count
     if not is_running():
         return "0^error,msg=\"no session running\""
 
@@ -1442,32 +2419,28 @@ def run_cmd(cmd, block=False, mimode=True, timeout=None):
             run_cmd(c, block, mimode, timeout)
         return count
 
-    if mimode:
-        count = count + 1
-        cmd = "%d%s\n" % (count, cmd)
-    else:
-        cmd = "%s\n\n" % cmd
-    log_debug(cmd)
-
-    start = datetime.now()
-    if gdb_session_view is not None:
-        gdb_session_view.add_line(cmd, False)
-    gdb_process.stdin.write(cmd.encode(sys.getdefaultencoding()))
-    gdb_process.stdin.flush()
-    if block:
-        countstr = "%d^" % count
-        r=""
-        while not r.startswith(countstr):
-            try:
-                r = gdb_lastresult.get(timeout=timeout)
-            except queue.Empty:
-                raise ValueError("Command \"%s\" took longer than %d seconds to perform?" % (cmd, timeout))
-        return r
-    return count
+    token, pending = write_cmd(cmd, mimode, block)
+    if pending is not None:
+        return pending.wait(timeout)
+    return token
+
+
+def run_cmds(cmds, timeout=None):
+    """Sends all of cmds to gdb at once and waits for their results, which
+    are returned in the same order. This costs one round trip to gdb
+    rather than one per command."""
+    if not is_running():
+        return ["0^error,msg=\"no session running\""] * len(cmds)
+    if len(cmds) == 0:
+        return []
+
+    timeout = timeout or get_setting("gdb_command_timeout", 10)
+    # the timeout is for the whole batch, not for each command in it
+    deadline = time.time() + timeout
+    return [pending.wait(timeout, deadline) for token, pending in write_cmds(cmds, pending=True)]
 
 
 def run_python_cmd(cmd, block=False, timeout=None):
-    global count
     global gdb_python_command_running
     global gdb_last_console_line
     if not is_running():
@@ -1475,30 +2448,15 @@ def run_python_cmd(cmd, block=False, timeout=None):
 
     timeout = timeout or get_setting("gdb_command_timeout", 10)
 
-    count = count + 1
-    cmd = "%d%s\n" % (count, cmd)
-    log_debug(cmd)
-
-    start = datetime.now()
-    if gdb_session_view is not None:
-        gdb_session_view.add_line(cmd, False)
     gdb_last_console_line = ""
-    gdb_process.stdin.write(cmd.encode(sys.getdefaultencoding()))
-    gdb_process.stdin.flush()
-    if block:
-        gdb_python_command_running = True
-        try:
-            countstr = "%d^" % count
-            r=""
-            while not r.startswith(countstr):
-                try:
-                    r = gdb_lastresult.get(timeout=timeout)
-                except queue.Empty:
-                    raise ValueError("Command \"%s\" took longer than %d seconds to perform?" % (cmd, timeout))
-            return gdb_last_console_line
-        finally:
-            gdb_python_command_running = False
-    return count
+    if not block:
+        return write_cmd(cmd)[0]
+    gdb_python_command_running = True
+    try:
+        write_cmd(cmd, pending=True)[1].wait(timeout)
+        return gdb_last_console_line
+    finally:
+        gdb_python_command_running = False
 
 
 def wait_until_stopped():
@@ -1529,18 +2487,39 @@ def get_result(line, show_error = True):
     return res
 
 
-def listify(var):
-    if not isinstance(var, list):
-        return [var]
-    return var
+def show_cursor(filename, line):
+    sublime.active_window().focus_group(get_setting("file_group", 0))
+
+    # If filename is not the exact name of an already opened file, Sublime
+    # Text will open a new view. To prevent that, look through all views to
+    # find the file name to use.
+    file_to_open = filename
+    try:
+        for view in sublime.active_window().views():
+            if view.file_name():
+                if os.path.samefile(filename, view.file_name()):
+                    file_to_open = view.file_name()
+    except Exception:
+        pass
+
+    sublime.active_window().open_file("%s:%d" % (file_to_open, line), sublime.ENCODED_POSITION)
 
 
-def update_cursor():
+def is_stale(generation):
+    return generation is not None and generation != gdb_stop_generation
+
+
+def update_cursor(generation=None):
+    # Queries gdb and so runs on gdb_worker rather than the UI thread.
+    # generation is the gdb_stop_generation of the stop this refresh is for,
+    # the refresh is abandoned as soon as there has been a newer one.
     global gdb_cursor
     global gdb_cursor_position
     global gdb_stack_index
     global gdb_stack_frame
 
+    if is_stale(generation):
+        return
     if not get_setting("update_while_running", True) and gdb_run_status == "running":
         return
 
@@ -1549,27 +2528,13 @@ def update_cursor():
         if gdb_run_status != "running":
             log_debug("run_status is %s, but got error: %s" % (gdb_run_status, res))
             return
-    currFrame = parse_result_line(res)["frame"]
+    currFrame = parse_result_line(res, ["frame"])["frame"]
     gdb_stack_index = int(currFrame["level"])
 
     if "fullname" in currFrame:
         gdb_cursor = currFrame["fullname"]
         gdb_cursor_position = int(currFrame["line"])
-        sublime.active_window().focus_group(get_setting("file_group", 0))
-
-        # If gdb_cursor is not the exact name of an already opened file, Sublime
-        # Text will open a new view. To prevent that, look through all views to
-        # find the file name to use.
-        file_to_open = gdb_cursor
-        try:
-            for view in sublime.active_window().views():
-                if view.file_name():
-                    if os.path.samefile(gdb_cursor, view.file_name()):
-                        file_to_open = view.file_name()
-        except Exception:
-            pass
-
-        sublime.active_window().open_file("%s:%d" % (file_to_open, gdb_cursor_position), sublime.ENCODED_POSITION)
+        sublime.set_timeout(partial(show_cursor, gdb_cursor, gdb_cursor_position), 0)
     else:
         gdb_cursor_position = 0
 
@@ -1580,15 +2545,26 @@ def update_cursor():
     if sameFrame and "fullname" in currFrame and "fullname" in gdb_stack_frame:
         sameFrame = currFrame["fullname"] == gdb_stack_frame["fullname"]
 
-    gdb_stack_frame = currFrame
+    if is_stale(generation):
+        return
     # Always need to update the callstack since it's possible to
     # end up in the current function from many different call stacks
     gdb_callstack_view.update_callstack()
+    if is_stale(generation):
+        return
     gdb_threads_view.update_threads()
 
-    update_view_markers()
+    sublime.set_timeout(update_view_markers, 0)
+    if is_stale(generation):
+        return
+    # only remember the frame once the variables actually belong to it
+    gdb_stack_frame = currFrame
     gdb_variables_view.update_variables(sameFrame)
+    if is_stale(generation):
+        return
     gdb_register_view.update_values()
+    if is_stale(generation):
+        return
     gdb_disassembly_view.update_disassembly()
 
 
@@ -1596,72 +2572,118 @@ def session_ended_status_message():
     sublime.status_message("GDB session ended")
 
 
+class MIReader(object):
+    """Reads lines from a pipe in large chunks rather than one at a time."""
+
+    # first byte of the lines that gdb itself writes; anything else is output
+    # from the program being debugged
+    record_start = frozenset(bencode("0123456789^*+=~@&("))
+
+    def __init__(self, fd, size=65536):
+        self.fd = fd
+        self.size = size
+        self.buffer = bytearray()
+
+    def readlines(self):
+        """Blocks until there is output and returns the complete lines read,
+        without their line endings, or None at the end of the stream."""
+        data = os.read(self.fd, self.size)
+        if len(data) == 0:
+            if len(self.buffer) == 0:
+                return None
+            lines = [bytes(self.buffer)]
+            del self.buffer[:]
+            return lines
+
+        self.buffer += data
+        end = self.buffer.rfind(b"\n")
+        if end == -1:
+            return []
+        # bytes rather than bytearrays so that indexing gives the same type
+        # as record_start on both Python 2 and 3
+        lines = [bytes(line) for line in self.buffer[:end].split(b"\n")]
+        del self.buffer[:end + 1]
+        return lines
+
+
 def gdboutput(pipe):
     global gdb_process
-    global gdb_lastresult
     global gdb_lastline
     global gdb_last_console_line
     global gdb_stack_frame
     global gdb_run_status
     global gdb_stack_index
-    command_result_regex = re.compile("^\d+\^")
-    run_status_regex = re.compile("(^\d*\*)([^,]+)")
+    global gdb_stop_generation
+    is_stdout = pipe == gdb_process.stdout
+    name = "stdout" if is_stdout else "stderr"
+    reader = MIReader(pipe.fileno())
+    encoding = sys.getdefaultencoding()
 
     while True:
         try:
-            raw = pipe.readline()
-            if len(raw) == 0:
-                log_debug("gdb_%s: broken pipe\n" % ("stdout" if pipe == gdb_process.stdout else "stderr"))
-                break
-            line = raw.strip().decode(sys.getdefaultencoding())
-            log_debug("gdb_%s: %s\n" % ("stdout" if pipe == gdb_process.stdout else "stderr", line))
-            gdb_session_view.add_line("%s\n" % line, False)
-
-            if pipe != gdb_process.stdout:
-                continue
-
-            if command_result_regex.match(line) is not None:
-                gdb_lastresult.put(line)
-
-            run_status = run_status_regex.match(line)
-            if run_status is not None:
-                gdb_run_status = run_status.group(2)
-                reason = re.search("(?<=reason=\")[a-zA-Z0-9\-]+(?=\")", line)
-                if reason is not None and reason.group(0).startswith("exited"):
-                    log_debug("gdb: exiting %s" % line)
-                    run_cmd("-gdb-exit")
-                elif not "running" in gdb_run_status and not gdb_shutting_down:
-                    thread_id = re.search('thread-id="(\d+)"', line)
-                    if thread_id is not None:
-                        gdb_threads_view.select_thread(int(thread_id.group(1)))
-                    sublime.set_timeout(update_cursor, 0)
-            if not line.startswith("(gdb)"):
-                gdb_lastline = line
-
-            if line.startswith("~"):
-                console_line = line[2:-1].replace("\\n", "\n").replace("\\\"", "\"").replace("\\t", "\t")
-                if not gdb_python_command_running:
-                    gdb_console_view.add_line(console_line, False)
-
-                # save the output (without the newline at the end)
-                gdb_last_console_line = console_line[:-1]
+            lines = reader.readlines()
+        except:
+            traceback.print_exc()
+            lines = None
+        if lines is None:
+            log_debug("gdb_%s: broken pipe\n" % name)
+            break
 
-            # filter out the program output and print it on the console view
-            if not (line.startswith("(gdb)") or line.startswith("~") or
-                    line.startswith("=") or line.startswith("&\"") or
-                    command_result_regex.match(line) or
-                    run_status_regex.match(line)):
+        session = []
+        for raw in lines:
+            try:
                 # use the raw output to show exactly what the program printed
-                console_line = raw.decode(sys.getdefaultencoding())
-
-                # correct the line endings
-                console_line = "\n".join(console_line.splitlines())
-
-                gdb_console_view.add_line("%s\n" % console_line, False)
+                text = raw.rstrip(b"\r").decode(encoding)
+                line = text.strip()
+                log_debug("gdb_%s: %s\n" % (name, line))
+                session.append("%s\n" % line)
+
+                if not is_stdout:
+                    continue
+
+                if len(raw) == 0 or raw[0] not in MIReader.record_start:
+                    gdb_lastline = line
+                    gdb_program_output.add("%s\n" % text)
+                    continue
+                if line == "(gdb)":
+                    continue
+                gdb_lastline = line
 
-        except:
-            traceback.print_exc()
+                record = parse_record(line, ["reason", "thread-id"])
+                if isinstance(record, ResultRecord) and record.token is not None:
+                    complete_cmd(record.token, line)
+                elif isinstance(record, ExecAsync):
+                    gdb_run_status = record.klass
+                    gdb_stop_generation += 1
+                    reason = record.results.get("reason")
+                    if reason is not None and reason.startswith("exited"):
+                        log_debug("gdb: exiting %s" % line)
+                        run_cmd("-gdb-exit")
+                    elif not "running" in gdb_run_status and not gdb_shutting_down:
+                        thread_id = record.results.get("thread-id")
+                        if thread_id is not None:
+                            gdb_threads_view.select_thread(int(thread_id))
+                        gdb_worker.post(update_cursor, gdb_stop_generation)
+                elif isinstance(record, Stream) and record.kind == "~":
+                    console_line = record.text
+                    if not gdb_python_command_running:
+                        gdb_console_view.add_line(console_line)
+
+                    # save the output (without the newline at the end)
+                    gdb_last_console_line = console_line[:-1]
+                elif isinstance(record, Stream) and record.kind == "@":
+                    # output from a remote target
+                    gdb_program_output.add(record.text)
+                elif record is None:
+                    # program output that happened to start like a record
+                    gdb_program_output.add("%s\n" % text)
+            except:
+                traceback.print_exc()
+        if session:
+            gdb_session_view.add_line("".join(session))
     if pipe == gdb_process.stdout:
+        # nothing will answer the commands still waiting for a result
+        cancel_pending_cmds()
         log_debug("GDB session ended\n")
         gdb_session_view.add_line("GDB session ended\n")
         sublime.set_timeout(session_ended_status_message, 0)
@@ -1677,7 +2699,6 @@ def gdboutput(pipe):
     sublime.set_timeout(cleanup, 0)
 
 def cleanup():
-    global __debug_file_handle
     global gdb_process
     global gdb_threads
 
@@ -1685,6 +2706,7 @@ def cleanup():
     for t in gdb_threads:
         t.join(get_setting("gdb_timeout", 20))
     gdb_threads = []
+    gdb_worker.stop()
 
     # unset the process variable to make sure all pipes and other OS objects are
     # released (this fixes different freezes when gdb is started multiple times)
@@ -1696,55 +2718,52 @@ def cleanup():
     if get_setting("push_pop_layout", True):
         gdb_bkp_window.set_layout(gdb_bkp_layout)
         gdb_bkp_window.focus_view(gdb_bkp_view)
-    if __debug_file_handle is not None:
-        if __debug_file_handle != sys.stdout:
-            __debug_file_handle.close()
-            __debug_file_handle = None
+    gdb_debug_log.close()
+
+
+# master side of the pty the program runs in, which is where
+# "SublimeGDB: Send Program Input" writes to
+gdb_program_pty = None
 
 
 def programio(pty, tty):
     global gdb_process
+    global gdb_program_pty
     exception_count = 0
     class MyFD(object):
+        # Reads the program's output in large chunks, from the master side of
+        # a pty or, where there are no ptys, from the temporary file gdb was
+        # told to use as the program's terminal.
         def __init__(self, pty, tty):
             self.pty = pty
             self.tty = tty
-            self.off = 0
-            self.queue = Queue.Queue()
-
-        def on_done(self, s):
-            log_debug("programinput: %s\n" % s)
-            log_debug("Wrote: %d bytes\n" % os.write(self.pty, bencode("%s\n" % s)))
-            os.fsync(self.pty)
-            self.queue.put(None)
-
-        def get_input(self):
-            sublime.active_window().show_input_panel("stdin input expected: ", "input", self.on_done, None, lambda: self.queue.put(None))
-
-        def readline(self):
-            ret = bytes()
-            while True:
-                if not os.isatty(self.pty):
-                    s = os.fstat(self.pty)
-                    if self.off >= s.st_size and len(ret) == 0:
-                        return bdecode(ret)
-                else:
-                    import select
-                    r, w, x = select.select([self.pty], [self.pty], [], 5.0)
-                    if len(r) == 0 and len(w) != 0:
-                        log_debug("Ready for input\n")
-                        sublime.set_timeout(self.get_input, 0)
-                        self.queue.get()
-                        continue
-                    elif len(r) == 0:
-                        log_debug("timed out\n")
-                        break
-                read = os.read(self.pty, 1)
-                self.off += len(read)
-                ret += read
-                if len(read) == 0 or ret[-1] == ord('\n'):
-                    break
-            return bdecode(ret)
+            self.buffer = bytearray()
+
+        def read(self, timeout):
+            """Returns the output read as text, all of it ending in complete
+            lines unless nothing more arrived within timeout seconds."""
+            if self.tty is not None:
+                # wake up as soon as there's output rather than polling
+                r, w, x = select.select([self.pty], [], [], timeout)
+                data = os.read(self.pty, 65536) if r else b""
+            else:
+                # regular files are always "ready", so poll those
+                data = os.read(self.pty, 65536)
+                if len(data) == 0:
+                    time.sleep(timeout)
+
+            self.buffer += data
+            if len(data) == 0:
+                # flush a partial line, such as a prompt, once output stops
+                end = len(self.buffer)
+            else:
+                end = self.buffer.rfind(b"\n") + 1
+            if end == 0:
+                return ""
+            ret = bytes(self.buffer[:end])
+            del self.buffer[:end]
+            # ptys turn "\n" into "\r\n"
+            return ret.decode("utf-8", "replace").replace("\r\n", "\n")
 
         def close(self):
             os.close(self.pty)
@@ -1752,22 +2771,26 @@ def programio(pty, tty):
                 os.close(self.tty)
 
     pipe = MyFD(pty, tty)
+    if tty is not None:
+        gdb_program_pty = pty
 
     while exception_count < 100:
         try:
-            line = pipe.readline()
-            if len(line) > 0:
-                log_debug("programoutput: %s" % line)
-                gdb_console_view.add_line(line, False)
+            text = pipe.read(0.1 if tty is None else 0.5)
+            if len(text) > 0:
+                log_debug("programoutput: %s" % text)
+                gdb_program_output.add(text)
+            elif gdb_process is None or gdb_process.poll() is not None:
+                break
             else:
-                if gdb_process.poll() is not None:
-                    break
-                time.sleep(0.1)
+                gdb_program_output.flush()
         except:
             traceback.print_exc()
             exception_count = exception_count + 1
+    gdb_program_pty = None
     if pipe is not None:
         pipe.close()
+    gdb_program_output.close()
 
 
 gdb_input_view = None
@@ -1847,29 +2870,45 @@ class GdbRawInput(sublime_plugin.WindowCommand):
         show_input(raw=True)
 
 
+class GdbProgramInput(sublime_plugin.WindowCommand):
+    def run(self):
+        self.window.show_input_panel("Program input", "", self.on_done, None, None)
+
+    def on_done(self, s):
+        pty = gdb_program_pty
+        if pty is None:
+            return
+        log_debug("programinput: %s\n" % s)
+        try:
+            os.write(pty, ("%s\n" % s).encode("utf-8"))
+        except OSError:
+            log_debug("programinput failed: %s" % traceback.format_exc())
+
+    def is_enabled(self):
+        return is_running() and gdb_program_pty is not None
+
+
 class GdbLaunch(sublime_plugin.WindowCommand):
     def run(self):
-        global exec_settings
         s = self.window.active_view().settings()
         exec_choices = s.get("sublimegdb_executables")
 
         if exec_choices is None or type(exec_choices) != dict:
             # No executable specific settings, go ahead and launch
             global gdb_threads
-            exec_settings = {}
+            set_exec_settings({})
             t = threading.Thread(target=self.launch)
             t.start()
             gdb_threads.append(t)
             return
 
         def on_choose(index):
-            global exec_settings
             global gdb_threads
             if index == -1:
                 # User cancelled the panel, abort launch
                 return
             exec_name = list(exec_choices)[index]
-            exec_settings = exec_choices[exec_name]
+            set_exec_settings(exec_choices[exec_name])
             t = threading.Thread(target=self.launch)
             t.start()
             gdb_threads.append(t)
@@ -1890,6 +2929,7 @@ class GdbLaunch(sublime_plugin.WindowCommand):
         view = self.window.active_view()
         DEBUG = get_setting("debug", False, view)
         DEBUG_FILE = expand_path(get_setting("debug_file", "stdout", view), self.window)
+        gdb_debug_log.open(DEBUG_FILE)
         if DEBUG:
             log_debug("Will write debug info to file: %s" % DEBUG_FILE)
         if gdb_process is None or gdb_process.poll() is not None:
@@ -1968,6 +3008,7 @@ class GdbLaunch(sublime_plugin.WindowCommand):
                 view.clear()
 
             gdb_shutting_down = False
+            gdb_program_output.start()
 
             t = threading.Thread(target=gdboutput, args=(gdb_process.stdout,))
             t.start()
@@ -1977,7 +3018,6 @@ class GdbLaunch(sublime_plugin.WindowCommand):
             gdb_threads.append(t)
 
             try:
-                raise Exception("Nope")
                 pty, tty = os.openpty()
                 name = os.ttyname(tty)
             except:
@@ -1995,18 +3035,18 @@ It seems you're not running gdb with the "mi" interpreter. Please add
 "--interpreter=mi" to your gdb command line""")
                 gdb_process.stdin.write("quit\n")
                 return
-            run_cmd("-inferior-tty-set %s" % name, True)
-
-            run_cmd("-enable-pretty-printing")
-            run_cmd("-gdb-set mi-async on")
-            run_cmd("-gdb-set pagination off")
             dis_asm_flavor = get_setting("disassembly_flavor", "att", view)
-            if dis_asm_flavor == "intel":
-                run_cmd("-gdb-set disassembly-flavor intel")
-            else:
-                run_cmd("-gdb-set disassembly-flavor att")
-            # if gdb_nonstop:
-            #     run_cmd("-gdb-set non-stop on")
+            if dis_asm_flavor != "intel":
+                dis_asm_flavor = "att"
+            run_cmds([
+                "-inferior-tty-set %s" % name,
+                "-enable-pretty-printing",
+                "-gdb-set mi-async on",
+                "-gdb-set pagination off",
+                "-gdb-set disassembly-flavor %s" % dis_asm_flavor
+                # if gdb_nonstop:
+                #     "-gdb-set non-stop on"
+            ])
             attach_cmd = get_setting("attach_cmd","notset")
             if(attach_cmd != "notset"):
                 run_cmd(attach_cmd, block=True, timeout=get_setting("gdb_timeout", 20))
@@ -2183,7 +3223,7 @@ class GdbClick(sublime_plugin.TextCommand):
             gdb_callstack_view.select(row)
         elif gdb_threads_view.is_open() and self.view.id() == gdb_threads_view.get_view().id():
             gdb_threads_view.select(row)
-            update_cursor()
+            gdb_worker.post(update_cursor)
 
     def is_enabled(self):
         return is_running()
@@ -2232,6 +3272,8 @@ class GdbEditVariable(sublime_plugin.TextCommand):
     def run(self, edit):
         row, col = self.view.rowcol(self.view.sel()[0].a)
         var = gdb_variables_view.get_variable_at_line(row)
+        if var is None:
+            return
         if var.is_editable():
             var.edit()
         else:
@@ -2300,6 +3342,8 @@ class GdbEventListener(sublime_plugin.EventListener):
             update_view_markers(view)
 
     def on_close(self, view):
+        forget_view_settings(view.id())
+        settings_listening.discard(view.id())
         for v in gdb_views:
             if v.is_open() and view.id() == v.get_view().id():
                 v.was_closed()
@@ -2383,6 +3427,55 @@ class GdbOpenBreakpointView(sublime_plugin.WindowCommand):
         return not gdb_breakpoint_view.is_open()
 
 
+class GdbShowDebugLog(sublime_plugin.WindowCommand):
+    def run(self):
+        view = self.window.new_file()
+        view.set_name("GDB Debug Log")
+        view.set_scratch(True)
+        view.run_command("append", {"characters": "".join(list(gdb_debug_log.ring)), "force": True})
+        view.set_read_only(True)
+
+    def is_enabled(self):
+        return len(gdb_debug_log.ring) > 0
+
+
+class GdbShowProgramOutput(sublime_plugin.WindowCommand):
+    def run(self):
+        name = gdb_program_output.spool_name
+        if name is None or not os.path.exists(name):
+            sublime.status_message("No program output has been saved")
+            return
+        gdb_program_output.flush()
+
+        # only the end of the file is read, through mmap so that a huge file
+        # doesn't have to be read in to get there
+        size = get_setting("program_output_tail_size", 1048576)
+        with open(name, "rb") as f:
+            length = os.fstat(f.fileno()).st_size
+            data = b""
+            if length > 0:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    start = max(0, length - size)
+                    end = m.find(b"\n", start)
+                    if start > 0 and end != -1:
+                        # start at a line
+                        start = end + 1
+                    data = m[start:]
+                finally:
+                    m.close()
+
+        view = self.window.new_file()
+        view.set_name("GDB Program Output")
+        view.set_scratch(True)
+        view.run_command("append", {"characters": data.decode("utf-8", "replace"), "force": True})
+        view.set_read_only(True)
+        view.run_command("move_to", {"to": "eof", "extend": False})
+
+    def is_enabled(self):
+        return gdb_program_output.spool_name is not None
+
+
 class GdbOpenThreadsView(sublime_plugin.WindowCommand):
     def run(self):
         gdb_threads_view.open()